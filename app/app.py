@@ -2,8 +2,9 @@ import os
 import logging
 import config
 import discord
-from discord.ext.commands import Bot
+from discord.ext.commands import AutoShardedBot, Bot
 
+import metrics
 import tasks
 from bot_config import BotConfig
 
@@ -29,9 +30,19 @@ intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
 
-bot = Bot('!', intents = intents)
+if cfg.sharded:
+    # Let discord.py pick the shard count from the gateway unless one is configured
+    bot = AutoShardedBot('!', intents = intents, shard_count = cfg.shard_count)
+else:
+    bot = Bot('!', intents = intents)
+metrics.instrument_bot(bot)
+metrics_server = None
 
 async def start():
+    global metrics_server
+    if cfg.metrics.enabled and metrics_server is None:
+        metrics_server = await metrics.serve(cfg.metrics.host, cfg.metrics.port)
+
     if cfg.tasks.uwu.enabled:
         await bot.add_cog(tasks.uwu.Uwu())
 
@@ -47,8 +58,10 @@ async def start():
 @bot.event
 async def on_ready():
     if bot.user is not None:
-        _LOG.info(f'We have logged in as {bot.user.name}')
-        await start()
+        _LOG.info(f'We have logged in as {bot.user.name} in {len(bot.guilds)} guilds')
+        # on_ready fires again after the gateway reconnects, but the tasks only need starting once
+        if not bot.cogs:
+            await start()
     else:
         _LOG.fatal(f'Unable to log in!')
 
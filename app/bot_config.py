@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Literal
 
 from pydantic import BaseModel
 
@@ -13,13 +13,42 @@ class ScoresaberConfig(RunConfig):
   enabled: bool = False
   channels: List[int] = []
   database: str = ''
+  database_readers: int = 2
   power_users: List[int] = []
   update_interval: float = 60.0
+  poll_min_interval: float = 60.0
+  poll_max_interval: float = 1800.0
+  poll_backoff: float = 2.0
+  poll_budget: int = 0
+  ingest_mode: Literal['poll', 'websocket'] = 'poll'
+  websocket_url: str = 'wss://scoresaber.com/ws'
+  reconcile_interval: float = 3600.0
+  announce_interval: float = 1.0
+  update_concurrency: int = 4
+  request_retries: int = 3
+  beatsaver_cache_size: int = 1024
+  beatsaver_negative_ttl: float = 86400.0
+  beatsaver_batch_size: int = 50
+  backfill_page_delay: float = 1.0
+  backfill_reserve: int = 100
+  backfill_retries: int = 5
 
 class MtgConfig(RunConfig):
   enabled: bool = False
   channels: List[int] = []
   page_size: int = 5
+  request_interval: float = 0.1
+  card_index: str | None = None
+  card_index_refresh: float = 86400.0
+  image_cache: str | None = None
+  image_cache_mb: int = 256
+  image_memory_mb: int = 32
+  lookups_per_message: int = 5
+
+class MetricsConfig(RunConfig):
+  enabled: bool = False
+  host: str = '127.0.0.1'
+  port: int = 9100
 
 class TaskConfig(BaseModel):
   uwu: UwuConfig
@@ -28,4 +57,7 @@ class TaskConfig(BaseModel):
 
 class BotConfig(BaseModel):
   bot_token: str
+  sharded: bool = False
+  shard_count: int | None = None
   tasks: TaskConfig
+  metrics: MetricsConfig = MetricsConfig()
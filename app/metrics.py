@@ -0,0 +1,220 @@
+'''
+Lightweight Prometheus-format metrics.
+
+Metrics are plain in-process counters and histograms that are updated from the event loop, so
+recording one is a dict lookup and an addition. They are always collected; `serve` exposes them
+as text on `/metrics` for Prometheus to scrape.
+'''
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import aiohttp
+from aiohttp import web
+from discord.ext import commands
+
+_LOG = logging.getLogger('discord-util').getChild('metrics')
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for (name, value) in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    '''
+    A value that only goes up, e.g. the number of requests sent
+    '''
+    name: str
+    help: str
+    labelnames: Tuple[str, ...]
+
+    _values: Dict[Tuple[str, ...], float]
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.register(self)
+
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for (key, value) in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    '''
+    Counts observations (usually durations in seconds) into buckets
+    '''
+    name: str
+    help: str
+    labelnames: Tuple[str, ...]
+    buckets: Tuple[float, ...]
+
+    # Per label set: the count in each bucket (not cumulative) and the sum of the observations
+    _series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]]
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = _DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        REGISTRY.register(self)
+
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = ([0] * (len(self.buckets) + 1), [0.0])
+            self._series[key] = series
+
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        '''
+        Observe how long the body of a `with` block takes
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for (key, (counts, total)) in sorted(self._series.items()):
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total[0]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    '''
+    Every metric that has been created, in the order they were created
+    '''
+    _metrics: List[Counter | Histogram]
+
+    def __init__(self):
+        self._metrics = []
+
+
+    def register(self, metric: Counter | Histogram):
+        self._metrics.append(metric)
+
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+UPDATE_SECONDS = Histogram('scoresaber_update_seconds', 'Time taken by each scoresaber update cycle', ['mode'])
+UPDATE_PLAYERS = Counter('scoresaber_update_players_total', 'Players checked for new scores')
+HTTP_SECONDS = Histogram('http_request_seconds', 'Time taken by outgoing HTTP requests', ['host'])
+HTTP_RESPONSES = Counter('http_responses_total', 'Outgoing HTTP requests by response status', ['host', 'status'])
+DATABASE_SECONDS = Histogram('database_query_seconds', 'Time taken by database methods', ['method'])
+COMMAND_SECONDS = Histogram('command_seconds', 'Time taken to handle bot commands', ['command', 'outcome'])
+DISCORD_SENDS = Counter('discord_messages_sent_total', 'Messages the bot has sent to Discord')
+DISCORD_SEND_ERRORS = Counter('discord_send_errors_total', 'Messages the bot failed to send to Discord')
+IMAGE_CACHE = Counter('card_image_cache_total', 'Card image lookups by the cache tier that answered them', ['result'])
+
+
+async def _on_request_start(session, context, params: aiohttp.TraceRequestStartParams):
+    context.start = time.perf_counter()
+
+
+async def _on_request_end(session, context, params: aiohttp.TraceRequestEndParams):
+    host = params.url.host or ''
+    HTTP_SECONDS.observe(time.perf_counter() - context.start, host=host)
+    HTTP_RESPONSES.inc(host=host, status=str(params.response.status))
+
+
+async def _on_request_exception(session, context, params: aiohttp.TraceRequestExceptionParams):
+    host = params.url.host or ''
+    HTTP_SECONDS.observe(time.perf_counter() - context.start, host=host)
+    HTTP_RESPONSES.inc(host=host, status='error')
+
+
+def http_trace() -> aiohttp.TraceConfig:
+    '''
+    A trace config that records latency and status for every request a `ClientSession` sends.
+    Pass it as `aiohttp.ClientSession(trace_configs=[metrics.http_trace()])`.
+    '''
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(_on_request_start)
+    trace.on_request_end.append(_on_request_end)
+    trace.on_request_exception.append(_on_request_exception)
+    return trace
+
+
+def instrument_bot(bot: commands.Bot):
+    '''
+    Time every command and count the messages the bot sends
+    '''
+    async def before_invoke(ctx: commands.Context):
+        ctx._metrics_start = time.perf_counter()
+
+    async def after_invoke(ctx: commands.Context):
+        start = getattr(ctx, '_metrics_start', None)
+        if start is not None and ctx.command is not None:
+            outcome = 'error' if ctx.command_failed else 'ok'
+            COMMAND_SECONDS.observe(time.perf_counter() - start, command=ctx.command.qualified_name, outcome=outcome)
+
+    async def on_message(message):
+        if bot.user is not None and message.author.id == bot.user.id:
+            DISCORD_SENDS.inc()
+
+    bot.before_invoke(before_invoke)
+    bot.after_invoke(after_invoke)
+    bot.add_listener(on_message, 'on_message')
+
+
+async def _handle(request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+async def serve(host: str, port: int) -> web.AppRunner:
+    '''
+    Serve the metrics on `http://host:port/metrics`
+    '''
+    app = web.Application()
+    app.router.add_get('/metrics', _handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    _LOG.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return runner
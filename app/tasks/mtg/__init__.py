@@ -1 +1,2 @@
 from .cards import get_card, scryfall_search
+from .client import ScryfallClient, ScryfallError
@@ -0,0 +1,274 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, Iterator, List, TextIO
+
+from peewee import CharField, Model, SqliteDatabase, TextField, chunked
+
+from .client import ScryfallClient
+from .name_matcher import NameMatch, NameMatcher, normalize_name
+
+_LOG = logging.getLogger('discord-util').getChild('mtg').getChild('card_index')
+
+database = SqliteDatabase(None)
+
+# Printings that share names with real cards, or aren't cards at all
+_SKIPPED_LAYOUTS = {'art_series', 'token', 'double_faced_token', 'emblem'}
+
+
+class BaseModel(Model):
+    '''
+    Base database model so we don't have to duplicate this Meta
+    '''
+    class Meta:
+        database = database
+
+
+class IndexedCard(BaseModel):
+    '''
+    The parts of a Scryfall card object needed to show it, looked up by normalized name
+    '''
+    id = CharField(primary_key=True)
+    name = CharField(null=False)
+    name_key = CharField(null=False, index=True)
+    set_code = CharField(null=False)
+    mana_cost = CharField(null=False)
+    type_line = CharField(null=False)
+    oracle_text = TextField(null=False)
+    flavor_text = TextField(null=True)
+    scryfall_uri = CharField(null=False)
+    image_uri = CharField(null=False)
+
+    class Meta:
+        indexes = (
+            (('set_code', 'name_key'), False),
+        )
+
+
+class IndexInfo(BaseModel):
+    '''
+    Key/value details about the index, e.g. which bulk data file it was built from
+    '''
+    key = CharField(primary_key=True)
+    value = TextField(null=True)
+
+
+def iter_json_array(stream: TextIO, chunk_size: int = 1 << 20) -> Iterator[Any]:
+    '''
+    Yield the items of a JSON array one at a time while reading it in chunks, so only the item
+    being decoded and one chunk are held in memory however big the file is
+    '''
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    started = False
+    eof = False
+
+    while True:
+        # Skip the whitespace and commas between items
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                (item, end) = decoder.raw_decode(buffer, position)
+                # Items are always followed by a separator, so a number cut off at the end of
+                # the buffer isn't taken as a shorter one
+                if eof or (end < len(buffer) and buffer[end] in ' \t\r\n,]'):
+                    yield item
+                    position = end
+                    continue
+            except json.JSONDecodeError:
+                # The item runs past the end of the buffer
+                if eof:
+                    raise
+
+        if eof:
+            return
+
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def _index_row(card: Dict[str, Any]) -> Dict[str, Any] | None:
+    '''
+    The row to store for a card, or None if it isn't a card that can be shown from the index
+    '''
+    if card.get('layout') in _SKIPPED_LAYOUTS:
+        return None
+
+    try:
+        return {
+            'id': card['id'],
+            'name': card['name'],
+            'name_key': normalize_name(card['name']),
+            'set_code': card['set'].lower(),
+            'mana_cost': card['mana_cost'],
+            'type_line': card['type_line'],
+            'oracle_text': card['oracle_text'],
+            'flavor_text': card.get('flavor_text'),
+            'scryfall_uri': card['scryfall_uri'],
+            'image_uri': card['image_uris']['normal'],
+        }
+    except KeyError:
+        # Cards with several faces keep these details per face, and go to the API instead
+        return None
+
+
+class CardIndex:
+    '''
+    Local copy of Scryfall's "oracle cards" bulk data, with one printing of every card, so most
+    card lookups don't need to ask the API.
+
+    The bulk data file is downloaded to disk and then read a chunk at a time into SQLite on a
+    worker thread, replacing the old contents in one transaction so lookups keep seeing the old
+    cards until the new ones are all in. A `NameMatcher` over every card name is built from the
+    stored cards when the index is first refreshed, and again after each download, for names
+    that are misspelled.
+    '''
+    db = database
+    matcher: NameMatcher | None
+
+    # Rows per statement for bulk inserts, kept well below SQLite's bound variable limit
+    _BATCH_SIZE = 80
+
+    def __init__(self, path: str):
+        database.init(path, pragmas={'journal_mode': 'wal'})
+        self.db.create_tables([IndexedCard, IndexInfo])
+        self.matcher = None
+
+
+    def close(self):
+        self.db.close()
+
+
+    def count(self) -> int:
+        return IndexedCard.select().count()
+
+
+    def updated_at(self) -> str | None:
+        '''
+        When the bulk data file the index was built from was published
+        '''
+        info = IndexInfo.get_or_none(IndexInfo.key == 'updated_at')
+        return info.value if info is not None else None
+
+
+    def lookup(self, name: str, set: str = '') -> Dict[str, Any] | None:
+        '''
+        Find a card by its full name, or by the start of its name if only one card starts that
+        way, or failing that by the one name that is clearly closest to it. Returns the card in
+        the same shape as the Scryfall API, or None if there's no match.
+        '''
+        key = normalize_name(name)
+        if not key:
+            return None
+
+        query = IndexedCard.select()
+        if set:
+            query = query.where(IndexedCard.set_code == set.lower())
+
+        card = query.where(IndexedCard.name_key == key).first()
+        if card is None:
+            # Keys sort directly after their prefix, so this is a range scan of the name index
+            candidates = list(query.where((IndexedCard.name_key > key) & (IndexedCard.name_key < key + '\uffff')).limit(2))
+            if len(candidates) == 1:
+                card = candidates[0]
+
+        if card is None and self.matcher is not None:
+            closest = self.matcher.best(name)
+            if closest is not None:
+                card = query.where(IndexedCard.name_key == normalize_name(closest)).first()
+
+        if card is None:
+            return None
+
+        return {
+            'id': card.id,
+            'name': card.name,
+            'set': card.set_code,
+            'mana_cost': card.mana_cost,
+            'type_line': card.type_line,
+            'oracle_text': card.oracle_text,
+            'scryfall_uri': card.scryfall_uri,
+            'image_uris': {'normal': card.image_uri},
+            **({'flavor_text': card.flavor_text} if card.flavor_text is not None else {}),
+        }
+
+
+    def suggest(self, name: str, limit: int = 3) -> List[NameMatch]:
+        '''
+        The card names closest to one that wasn't found, best first
+        '''
+        if self.matcher is None:
+            return []
+        return self.matcher.match(name, limit)
+
+
+    def build_matcher(self) -> NameMatcher:
+        '''
+        Build a name matcher over every card in the index
+        '''
+        names = IndexedCard.select(IndexedCard.name).distinct().tuples()
+        return NameMatcher(name for (name,) in names)
+
+
+    def _rows(self, path: str) -> Iterator[Dict[str, Any]]:
+        with open(path, encoding='utf-8') as stream:
+            for card in iter_json_array(stream):
+                row = _index_row(card)
+                if row is not None:
+                    yield row
+
+
+    def ingest(self, path: str, updated_at: str | None) -> int:
+        '''
+        Replace the index with the cards in a bulk data file. Returns the number of cards stored
+        '''
+        count = 0
+        with self.db.atomic():
+            IndexedCard.delete().execute()
+            for batch in chunked(self._rows(path), self._BATCH_SIZE):
+                IndexedCard.insert_many(batch).on_conflict_replace().execute()
+                count += len(batch)
+            IndexInfo.replace(key='updated_at', value=updated_at).execute()
+
+        return count
+
+
+    async def refresh(self, client: ScryfallClient, force: bool = False) -> int | None:
+        '''
+        Rebuild the index if Scryfall has published newer bulk data. Returns the number of cards
+        stored, or None if the index was already up to date.
+        '''
+        if self.matcher is None:
+            self.matcher = await asyncio.to_thread(self.build_matcher)
+
+        bulk = await client.bulk_data('oracle_cards')
+        if not force and bulk['updated_at'] == self.updated_at() and self.count() > 0:
+            _LOG.debug(f'Card index is up to date with {bulk["updated_at"]}')
+            return None
+
+        _LOG.info(f'Downloading card data from {bulk["download_uri"]}')
+        path = f'{self.db.database}.download'
+        try:
+            await client.download(bulk['download_uri'], path)
+            count = await asyncio.to_thread(self.ingest, path, bulk['updated_at'])
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.matcher = await asyncio.to_thread(self.build_matcher)
+        _LOG.info(f'Indexed {count} cards from {bulk["updated_at"]}')
+        return count
@@ -1,12 +1,11 @@
-import aiohttp
 import io
 import logging
-import scrython
-import time
 
-_LOG = logging.getLogger('discord-util').getChild("mtg").getChild('cards')
+from .card_index import CardIndex
+from .client import ScryfallClient, ScryfallError
+from .image_cache import ImageCache
 
-rate_limit = 0.05
+_LOG = logging.getLogger('discord-util').getChild("mtg").getChild('cards')
 
 def format_nameline(name: str, cost: str):
     fmt_string = f'**{name}**'
@@ -24,12 +23,10 @@ def format_flavor(text: str):
 def format_link(url: str):
     return url.split('?')[0]
 
-async def parse_scryfall_dict(card: dict) -> 'tuple[str, str, io.BytesIO]':
+async def parse_scryfall_dict(client: ScryfallClient, card: dict, images: ImageCache | None = None) -> 'tuple[str, str, io.BytesIO]':
     '''
-    Parse the raw scryfall JSON ourselves
-
-    Search results only return the JSON, not the scrython Card
-    object, and we don't want to duplicate this.
+    Format the raw scryfall JSON for a card and download its image, through the image cache if
+    there is one
     '''
     nameline = f'>>> {format_nameline(card["name"], card["mana_cost"])}'
     typeline = card['type_line']
@@ -45,50 +42,68 @@ async def parse_scryfall_dict(card: dict) -> 'tuple[str, str, io.BytesIO]':
     text = '\n'.join([line for line in lines if line])
 
     data = None
-    async with aiohttp.ClientSession() as session:
-        normal_uri = card['image_uris']['normal']
-        async with session.get(normal_uri) as resp:
-            if resp.status != 200:
-                text.append(f'\n{card.image_url}')
-            else:
-                data = io.BytesIO(await resp.read())
+    normal_uri = card['image_uris']['normal']
+    if images is not None and 'id' in card:
+        image = await images.get(ImageCache.key(card['id'], 'normal'), lambda: client.image(normal_uri))
+    else:
+        image = await client.image(normal_uri)
+
+    if image is None:
+        text += f'\n{normal_uri}'
+    else:
+        # BytesIO shares the cached bytes until something writes to it, so this doesn't copy them
+        data = io.BytesIO(image)
 
     return (card['name'], text, data)
 
 
-async def get_card(name: str, set: str = '') -> 'tuple[str, str, io.BytesIO]':
-    '''Get a single card with near-exact matching from scryfall'''
+async def get_card(client: ScryfallClient,
+                   name: str,
+                   set: str = '',
+                   index: CardIndex | None = None,
+                   images: ImageCache | None = None) -> 'tuple[str, str, io.BytesIO]':
+    '''
+    Get a single card with near-exact matching, from the local card index if there is one and
+    otherwise from scryfall
+    '''
+    if index is not None:
+        card = index.lookup(name, set)
+        if card is not None:
+            return await parse_scryfall_dict(client, card, images)
+
     try:
-        if set:
-            card = scrython.cards.Named(fuzzy=name, set=set)
-        else:
-            card = scrython.cards.Named(fuzzy=name)
-    except Exception as ex:
-        time.sleep(rate_limit)
-        auto = scrython.cards.Autocomplete(q=name, query=name)
+        card = await client.named(fuzzy=name, set=set)
+    except ScryfallError as ex:
+        _LOG.debug(f'Fuzzy lookup of "{name}" failed ({ex.code}), trying autocomplete')
+        auto = await client.autocomplete(name)
 
-        if auto and len(auto.data()) == 1:
-            time.sleep(rate_limit)
-            card = scrython.cards.Named(exact=auto.data()[0])
+        if auto and len(auto) == 1:
+            card = await client.named(exact=auto[0])
         else:
             return None
 
-    return await parse_scryfall_dict(card.scryfallJson)
+    return await parse_scryfall_dict(client, card, images)
 
 
-async def scryfall_search(query: str, max: int = 5) -> 'tuple[list[tuple[str | None, str, io.BytesIO | None]], str]':
+async def scryfall_search(client: ScryfallClient,
+                          query: str,
+                          max: int = 5,
+                          images: ImageCache | None = None) -> 'tuple[list[tuple[str | None, str, io.BytesIO | None]], str]':
     '''Search scryfall for cards'''
     try:
-        cards = scrython.cards.Search(q=query)
+        cards = await client.search(query)
 
-        if cards.total_cards() > max:
-            return (None, f'Found {cards.total_cards()} matches. Please narrow your search')
+        if cards['total_cards'] > max:
+            return (None, f'Found {cards["total_cards"]} matches. Please narrow your search')
 
         results = []
-        for card in cards.data():
-            results.append(await parse_scryfall_dict(card))
-            time.sleep(rate_limit)
+        for card in cards['data']:
+            results.append(await parse_scryfall_dict(client, card, images))
 
         return (results, None)
+    except ScryfallError as ex:
+        if ex.code == 'not_found':
+            return ([], None)
+        return (None, 'Unexpected error when searching')
     except Exception as ex:
         return (None, 'Unexpected error when searching')
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List
+
+import aiohttp
+
+import metrics
+
+_LOG = logging.getLogger('discord-util').getChild('mtg').getChild('client')
+
+scryfall_api_url = 'https://api.scryfall.com'
+
+# Scryfall asks every client to identify itself and to ask for JSON explicitly
+_HEADERS = {
+    'User-Agent': 'discord-util-bot/1.0',
+    'Accept': 'application/json',
+}
+
+
+class ScryfallError(Exception):
+    '''
+    An error object returned by the Scryfall API, e.g. `not_found` when a card name doesn't match
+    '''
+    status: int
+    code: str
+    details: str
+
+    def __init__(self, status: int, code: str, details: str):
+        super().__init__(f'{status} {code}: {details}')
+        self.status = status
+        self.code = code
+        self.details = details
+
+
+class RateLimiter:
+    '''
+    Spaces requests at least `interval` seconds apart. Scryfall asks for 50-100 ms between
+    requests. Waiting callers are let through in the order they arrived.
+    '''
+    interval: float
+
+    _next: float
+    _lock: asyncio.Lock
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+
+    async def acquire(self):
+        '''
+        Wait until a request is allowed to be sent
+        '''
+        async with self._lock:
+            wait = self._next - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._next = time.monotonic() + self.interval
+
+
+    def block_for(self, seconds: float):
+        '''
+        Hold off all requests for a while, e.g. after a 429
+        '''
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+class ScryfallClient:
+    '''
+    Shared HTTP client for the Scryfall API.
+
+    API requests wait on a `RateLimiter` before they are sent and 429 responses are retried after
+    a pause. Card images are served from Scryfall's CDN, which isn't rate limited, so image
+    downloads skip the limiter.
+    '''
+    retries: int
+    limiter: RateLimiter
+
+    _session: aiohttp.ClientSession | None
+
+    def __init__(self, interval: float = 0.1, retries: int = 2, limiter: RateLimiter | None = None):
+        self.retries = max(0, retries)
+        self.limiter = limiter if limiter is not None else RateLimiter(interval)
+        self._session = None
+
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Sessions have to be created from inside the event loop, so this can't happen in __init__
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(headers=_HEADERS, trace_configs=[metrics.http_trace()])
+        return self._session
+
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+    async def _get(self, path: str, params: Dict[str, str]) -> Any:
+        '''
+        GET an API endpoint and return the decoded JSON. Raises `ScryfallError` for error responses
+        '''
+        url = f'{scryfall_api_url}{path}'
+        attempt = 0
+        while True:
+            await self.limiter.acquire()
+            _LOG.log(level = 5, msg = f'GET {url} {params}')
+
+            async with self._get_session().get(url, params=params) as r:
+                if r.status == 429 and attempt < self.retries:
+                    retry_after = r.headers.get('retry-after')
+                    delay = float(retry_after) if retry_after is not None and retry_after.isdigit() else 1.0
+                    _LOG.debug(f'Rate limited by Scryfall, retrying in {delay:.2f}s')
+                    self.limiter.block_for(delay)
+                    attempt += 1
+                    continue
+
+                data = await r.json(content_type=None)
+                if r.status != 200 or data.get('object') == 'error':
+                    raise ScryfallError(r.status, data.get('code', 'unknown'), data.get('details', r.reason or ''))
+                return data
+
+
+    async def named(self, fuzzy: str = '', exact: str = '', set: str = '') -> Dict[str, Any]:
+        '''
+        Look up one card by name, fuzzily or exactly, optionally limited to a set code
+        '''
+        params = {'fuzzy': fuzzy} if fuzzy else {'exact': exact}
+        if set:
+            params['set'] = set
+        return await self._get('/cards/named', params)
+
+
+    async def autocomplete(self, q: str) -> List[str]:
+        '''
+        Up to 20 card names that start with or contain `q`
+        '''
+        return (await self._get('/cards/autocomplete', {'q': q}))['data']
+
+
+    async def search(self, q: str) -> Dict[str, Any]:
+        '''
+        The first page of results for a full-text search query, as Scryfall's list object
+        '''
+        return await self._get('/cards/search', {'q': q})
+
+
+    async def bulk_data(self, type: str) -> Dict[str, Any]:
+        '''
+        Details of one of Scryfall's daily bulk data files, e.g. `oracle_cards`, including its
+        `download_uri` and when it was last `updated_at`
+        '''
+        return await self._get(f'/bulk-data/{type.replace("_", "-")}', {})
+
+
+    async def download(self, url: str, path: str, chunk_size: int = 1 << 16):
+        '''
+        Stream a file to disk, e.g. a bulk data file, without holding it in memory. Bulk data is
+        served from Scryfall's CDN, so this skips the limiter.
+        '''
+        async with self._get_session().get(url) as r:
+            r.raise_for_status()
+            with open(path, 'wb') as file:
+                async for chunk in r.content.iter_chunked(chunk_size):
+                    file.write(chunk)
+
+
+    async def image(self, url: str) -> bytes | None:
+        '''
+        Download a card image, or None if it couldn't be fetched
+        '''
+        async with self._get_session().get(url) as r:
+            if r.status != 200:
+                _LOG.debug(f'Got {r.status} {r.reason} fetching image {url}')
+                return None
+            return await r.read()
@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict
+
+import metrics
+
+_LOG = logging.getLogger('discord-util').getChild('mtg').getChild('image_cache')
+
+# A Scryfall card ID and an image variant, e.g. `0000579f-7b35-4ed3-b44c-db2a538066fe-normal`
+_KEY_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}-[a-z_]+')
+
+_TEMP_PREFIX = 'partial-'
+_TEMP_SUFFIX = '.tmp'
+
+
+class ImageCache:
+    '''
+    Card images, keyed by Scryfall card ID and image variant.
+
+    Images are kept in memory up to `memory_size` bytes and, if a directory is given, on disk up
+    to `disk_size` bytes, each tier dropping its least recently used images first. Files are
+    written under a temporary name and renamed into place, so a crash never leaves a partial
+    image behind. Disk reads and writes run on worker threads. Concurrent requests for the same
+    image share one download.
+    '''
+    directory: str | None
+    memory_size: int
+    disk_size: int
+
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    _memory: 'OrderedDict[str, bytes]'
+    _memory_bytes: int
+    _disk: 'OrderedDict[str, int]'
+    _disk_bytes: int
+    _inflight: Dict[str, 'asyncio.Future[bytes | None]']
+
+    def __init__(self, directory: str | None = None, memory_size: int = 32 << 20, disk_size: int = 256 << 20):
+        self.directory = directory
+        self.memory_size = max(0, memory_size)
+        self.disk_size = max(0, disk_size)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._inflight = {}
+
+        if directory is not None:
+            self._load_directory()
+
+
+    @staticmethod
+    def key(card_id: str, variant: str = 'normal') -> str:
+        return f'{card_id}-{variant}'
+
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+
+    def _load_directory(self):
+        '''
+        Pick up the images already on disk, oldest first by when they were last used. Only files
+        named like cache keys are counted or ever deleted, so anything else in the directory is
+        left alone.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.is_file():
+                    continue
+                if entry.name.startswith(_TEMP_PREFIX) and entry.name.endswith(_TEMP_SUFFIX):
+                    # Left over from a write that never finished
+                    os.remove(entry.path)
+                    continue
+                if not _KEY_PATTERN.fullmatch(entry.name):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for (_, name, size) in sorted(entries):
+            self._disk[name] = size
+            self._disk_bytes += size
+
+        _LOG.debug(f'Found {len(self._disk)} cached images using {self._disk_bytes} bytes')
+
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.memory_size:
+            return
+
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_size:
+            (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+
+    def _read_file(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            # The modification time doubles as the last use, so the order survives a restart
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+
+    def _write_file(self, key: str, data: bytes, evicted: 'list[str]'):
+        (handle, temp_path) = tempfile.mkstemp(dir=self.directory, prefix=_TEMP_PREFIX, suffix=_TEMP_SUFFIX)
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        for name in evicted:
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+
+    async def _from_disk(self, key: str) -> bytes | None:
+        if key not in self._disk:
+            return None
+
+        data = await asyncio.to_thread(self._read_file, key)
+        if data is None:
+            # Deleted from outside the bot
+            self._disk_bytes -= self._disk.pop(key, 0)
+            return None
+
+        if key in self._disk:
+            self._disk.move_to_end(key)
+        return data
+
+
+    async def _to_disk(self, key: str, data: bytes):
+        if len(data) > self.disk_size:
+            return
+
+        self._disk_bytes -= self._disk.pop(key, 0)
+        self._disk[key] = len(data)
+        self._disk_bytes += len(data)
+
+        evicted = []
+        while self._disk_bytes > self.disk_size:
+            (name, size) = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            evicted.append(name)
+
+        if evicted:
+            _LOG.debug(f'Evicting {len(evicted)} images from the disk cache')
+
+        try:
+            await asyncio.to_thread(self._write_file, key, data, evicted)
+        except OSError as ex:
+            _LOG.warning(f'Could not cache image {key}: {ex}')
+            self._disk_bytes -= self._disk.pop(key, 0)
+
+
+    async def _load(self, key: str, fetch: Callable[[], Awaitable[bytes | None]]) -> bytes | None:
+        if self.directory is not None:
+            data = await self._from_disk(key)
+            if data is not None:
+                self.disk_hits += 1
+                metrics.IMAGE_CACHE.inc(result='disk')
+                self._remember(key, data)
+                return data
+
+        self.misses += 1
+        metrics.IMAGE_CACHE.inc(result='miss')
+        data = await fetch()
+        if data is None:
+            return None
+
+        self._remember(key, data)
+        if self.directory is not None:
+            await self._to_disk(key, data)
+        return data
+
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[bytes | None]]) -> bytes | None:
+        '''
+        Get an image from the cache, or download it with `fetch` and cache it. Images that
+        couldn't be downloaded (None) aren't cached.
+        '''
+        if not _KEY_PATTERN.fullmatch(key):
+            raise ValueError(f'Invalid image cache key: {key}')
+
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            metrics.IMAGE_CACHE.inc(result='memory')
+            return data
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._inflight.pop(key) if self._inflight.get(key) is done else None)
+
+        # Shielded so one caller giving up doesn't cancel the download for everyone else
+        return await asyncio.shield(task)
+
+
+    def stats(self) -> dict[str, int]:
+        '''
+        Cache counters for logging
+        '''
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_images': len(self._memory),
+            'memory_bytes': self._memory_bytes,
+            'disk_images': len(self._disk),
+            'disk_bytes': self._disk_bytes,
+        }
@@ -1,10 +1,21 @@
+import asyncio
+import io
+import logging
 import re
 import discord
 import discord.ext.commands as commands
+from discord.ext import tasks
 
 from bot_config import MtgConfig
 
+from .card_index import CardIndex
 from .cards import get_card, scryfall_search
+from .client import ScryfallClient
+from .image_cache import ImageCache
+
+_LOG = logging.getLogger('discord-util').getChild('mtg')
+
+_CARD_PATTERN = re.compile(r'\[\[(.*?)\]\]', re.MULTILINE)
 
 
 def _ctx_in_channel(ctx: commands.Context) -> bool:
@@ -23,32 +34,92 @@ def _sent_by_bot(message: discord.Message, bot: commands.Bot) -> bool:
 
 class Mtg(commands.Cog):
     bot: commands.Bot
+    client: ScryfallClient
+    index: CardIndex | None
+    images: ImageCache
+
+    _lookups: asyncio.Semaphore
 
 
     def __init__(self, bot: commands.Bot, cfg: MtgConfig):
         Mtg._CFG = cfg
         self.bot = bot
+        self.client = ScryfallClient(cfg.request_interval)
+        self.index = CardIndex(cfg.card_index) if cfg.card_index else None
+        self.images = ImageCache(cfg.image_cache, cfg.image_memory_mb << 20, cfg.image_cache_mb << 20)
+
+        # Card lookups in flight across every message, capped at about a second's worth of
+        # Scryfall requests so a flood of mentions queues here rather than on the rate limiter
+        self._lookups = asyncio.Semaphore(round(1 / max(self.client.limiter.interval, 0.05)))
+
+
+        @tasks.loop(seconds=cfg.card_index_refresh)
+        async def refresh_index():
+            '''Keep the local card index in step with Scryfall's daily bulk data'''
+            try:
+                await self.index.refresh(self.client)
+            except Exception as ex:
+                # Lookups fall back to the API until the next attempt
+                _LOG.warning(f'Could not refresh the card index: {ex}')
+
+        self._refresh_index = refresh_index
+
+
+    async def cog_load(self):
+        if self.index is not None:
+            self._refresh_index.start()
+
+
+    async def cog_unload(self):
+        self._refresh_index.cancel()
+        await self.client.close()
+        if self.index is not None:
+            self.index.close()
+
+
+    async def _lookup(self, card: str, set: str, slots: asyncio.Semaphore) -> 'tuple[str, str, io.BytesIO] | None':
+        '''Look up one card, waiting for a free slot for its message and then a free lookup slot'''
+        async with slots, self._lookups:
+            try:
+                return await get_card(self.client, name=card, set=set, index=self.index, images=self.images)
+            except Exception as ex:
+                _LOG.warning(f'Error looking up "{card}": {ex}')
+                return None
 
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
         if not _sent_by_bot(message, self.bot) and _msg_in_channel(message):
-            matches = re.findall(r'\[\[(.*?)\]\]', message.content, re.MULTILINE)
+            matches = _CARD_PATTERN.findall(message.content)
             if len(matches) > 0:
-                cards = []
-                misses = []
+                # Each card is looked up once, in the order it was first mentioned
+                requested: 'dict[tuple[str, str], tuple[str, str]]' = {}
                 for match in matches:
                     (card, set) = match.split('|', 1) if match.find('|') > -1 else (match, '')
-                    result = await get_card(name=card, set=set)
+                    requested.setdefault((card.strip().lower(), set.strip().lower()), (card, set))
 
+                # Every card is looked up, but a message with lots of mentions only takes a few of
+                # the shared lookup slots at a time so other messages aren't stuck behind it
+                lookups = list(requested.values())
+                slots = asyncio.Semaphore(max(1, Mtg._CFG.lookups_per_message))
+                results = await asyncio.gather(*(self._lookup(card, set, slots) for (card, set) in lookups))
+
+                cards = []
+                misses = []
+                for ((card, set), result) in zip(lookups, results):
                     if result is None:
                         miss = f'"{card}"'
                         if set:
                             miss += f' in {set}'
+                        suggestions = self.index.suggest(card) if self.index is not None else []
+                        if suggestions:
+                            miss += f' (did you mean {" or ".join(match.name for match in suggestions)}?)'
                         misses.append(miss)
                     else:
                         cards.append(result)
 
+                _LOG.debug(f'Image cache: {self.images.stats()}')
+
                 if len(misses) > 0 :
                     cards.insert(0, (None, f'No matches found for {", ".join(misses)}\n', None))
 
@@ -79,7 +150,7 @@ class Mtg(commands.Cog):
         page_size = Mtg._CFG.page_size
 
         try:
-            (cards, error) = await scryfall_search(arg, page_size)
+            (cards, error) = await scryfall_search(self.client, arg, page_size, self.images)
         except Exception as ex:
             await ctx.message.channel.send('Error processing search. Use !help search for details on how to use this command.')
             return
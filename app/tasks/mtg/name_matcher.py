@@ -0,0 +1,128 @@
+import collections
+import heapq
+import itertools
+import math
+import re
+import unicodedata
+from typing import Dict, Iterable, List, NamedTuple
+
+
+def normalize_name(name: str) -> str:
+    '''
+    Lowercase a card name and strip accents and punctuation, so "Æther Vial" and "aether vial"
+    match
+    '''
+    name = unicodedata.normalize('NFKD', name.lower().replace('æ', 'ae'))
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    name = re.sub(r"['’]", '', name)
+    return ' '.join(re.sub(r'[^\w\s]', ' ', name).split())
+
+
+def _trigrams(key: str) -> 'set[str]':
+    # Padding the start twice weights the first letters, which people rarely get wrong
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameMatch(NamedTuple):
+    '''
+    A candidate card name and how similar it is to what was asked for, from 0 to 1
+    '''
+    name: str
+    score: float
+
+
+class NameMatcher:
+    '''
+    Fuzzy matching of card names, for names with typos or missing words.
+
+    Names are broken into trigrams (every run of three characters), with an inverted index from
+    each trigram to the names containing it. A query is scored against every name sharing at
+    least one of its trigrams by the Jaccard similarity of their trigram sets, so only the names
+    that could possibly match are looked at, and the counting is done by `collections.Counter`
+    rather than in Python.
+
+    Trigrams found in lots of names (e.g. the start of "the") make up most of the counting, so a
+    few of the most common ones in each query are left out of it. A name still needs enough of
+    the remaining trigrams to be able to reach the minimum score, which leaves only a handful of
+    names to check for the common trigrams one by one.
+    '''
+    names: List[str]
+
+    _sizes: List[int]
+    _postings: Dict[str, List[int]]
+    _common: Dict[str, 'frozenset[int]']
+
+    # Trigrams in at least this many names can be left out of the counting
+    _COMMON_SIZE = 128
+    # The fewest trigrams a name must share with the query after leaving out common ones
+    _MIN_SHARED = 3
+
+    def __init__(self, names: Iterable[str]):
+        self.names = []
+        self._sizes = []
+        self._postings = collections.defaultdict(list)
+
+        for name in names:
+            grams = _trigrams(normalize_name(name))
+            position = len(self.names)
+            self.names.append(name)
+            self._sizes.append(len(grams))
+            for gram in grams:
+                self._postings[gram].append(position)
+
+        self._postings = dict(self._postings)
+        self._common = {gram: frozenset(positions) for (gram, positions) in self._postings.items()
+                        if len(positions) >= self._COMMON_SIZE}
+
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+    def match(self, name: str, limit: int = 5, min_score: float = 0.3) -> List[NameMatch]:
+        '''
+        The names most similar to `name`, best first, scoring at least `min_score`
+        '''
+        grams = _trigrams(normalize_name(name))
+        found = sorted((gram for gram in grams if gram in self._postings), key=lambda gram: len(self._postings[gram]))
+        if not found:
+            return []
+
+        # A name sharing `count` trigrams scores at most count / len(grams), so names that can't
+        # reach min_score are dropped before scoring
+        needed = max(1, math.ceil(min_score * len(grams)))
+
+        # Leave the most common trigrams out of the count. A name needs that many fewer of the
+        # rest to still be in the running, and only those names are checked for the common ones
+        skip = 0
+        while skip < needed - self._MIN_SHARED and found[-1 - skip] in self._common:
+            skip += 1
+        counted = len(found) - skip
+        common = [self._common[gram] for gram in found[counted:]]
+        least = needed - skip
+
+        shared = collections.Counter(itertools.chain.from_iterable(self._postings[gram] for gram in found[:counted]))
+        sizes = self._sizes
+        scored = []
+        for (position, count) in shared.items():
+            if count >= least:
+                count += sum(position in positions for positions in common)
+                if count >= needed:
+                    scored.append((count / (len(grams) + sizes[position] - count), position))
+
+        return [NameMatch(self.names[position], score)
+                for (score, position) in heapq.nlargest(limit, scored)
+                if score >= min_score]
+
+
+    def best(self, name: str, min_score: float = 0.5, margin: float = 0.1) -> str | None:
+        '''
+        The closest name, if it's close enough and clearly closer than the next best
+        '''
+        matches = self.match(name, 2, min_score)
+        if not matches:
+            return None
+        if len(matches) > 1 and matches[0].score - matches[1].score < margin:
+            return None
+        return matches[0].name
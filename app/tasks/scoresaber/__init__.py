@@ -1,6 +1,6 @@
 from typing import List
 
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 
 
 class ScoresaberDifficulty(BaseModel):
@@ -51,6 +51,37 @@ class ScoresaberScore(BaseModel):
   timeSet: str
   hasReplay: bool
 
+# Slim projections of the models above with only the fields the updater reads. Anything else in
+# the payload is skipped without being validated, which is much cheaper for large pages.
+
+class ScoresaberSlimDifficulty(BaseModel):
+  difficulty: int
+
+class ScoresaberSlimLeaderboard(BaseModel):
+  songHash: str
+  songName: str
+  songAuthorName: str
+  levelAuthorName: str
+  difficulty: ScoresaberSlimDifficulty
+  maxScore: int
+  coverImage: str
+
+class ScoresaberSlimScore(BaseModel):
+  id: int
+  modifiedScore: int
+  badCuts: int
+  missedNotes: int
+  fullCombo: bool
+  timeSet: str
+
+class ScoresaberPlayerScore(BaseModel):
+  score: ScoresaberSlimScore
+  leaderboard: ScoresaberSlimLeaderboard
+
+# Validates a whole page of `playerScores` in one call
+player_scores_adapter = TypeAdapter(List[ScoresaberPlayerScore])
+
 scoresaber_url = 'https://scoresaber.com/api/v1'
+scoresaber_ws_url = 'wss://scoresaber.com/ws'
 beatsaver_api_url = 'https://api.beatsaver.com'
 beatsaver_maps_url = 'https://beatsaver.com/maps'
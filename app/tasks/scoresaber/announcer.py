@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from typing import Dict, List
+
+import discord
+
+import metrics
+
+_LOG = logging.getLogger('discord-util').getChild('scoresaber').getChild('announcer')
+
+# Discord limits for a single message
+_MAX_CONTENT = 2000
+_MAX_EMBEDS = 10
+_MAX_EMBED_TOTAL = 6000
+
+
+class Announcer:
+    '''
+    Posts new high scores to Discord with as few messages as possible.
+
+    Each record's text and embed go in the same message, and up to 10 records are packed into
+    one message. Messages are queued per channel and sent `interval` seconds apart so a burst of
+    records doesn't run into Discord's per-channel rate limit. Bursts larger than
+    `digest_threshold` are posted as a compact text digest instead of one embed per record.
+    '''
+    interval: float
+    digest_threshold: int
+
+    _queues: Dict[int, 'asyncio.Queue[tuple[str | None, List[discord.Embed]]]']
+    _workers: Dict[int, asyncio.Task]
+
+    def __init__(self, interval: float = 1.0, digest_threshold: int = 20):
+        self.interval = interval
+        self.digest_threshold = digest_threshold
+        self._queues = {}
+        self._workers = {}
+
+
+    @staticmethod
+    def pack(records: List[tuple[str, discord.Embed]]) -> List[tuple[str | None, List[discord.Embed]]]:
+        '''
+        Group records into as few messages as Discord's limits allow
+        '''
+        messages: List[tuple[str | None, List[discord.Embed]]] = []
+        lines: List[str] = []
+        embeds: List[discord.Embed] = []
+
+        for (text, embed) in records:
+            content_length = len('\n'.join(lines + [text]))
+            embed_length = sum(len(e) for e in embeds) + len(embed)
+
+            if embeds and (len(embeds) >= _MAX_EMBEDS or content_length > _MAX_CONTENT or embed_length > _MAX_EMBED_TOTAL):
+                messages.append(('\n'.join(lines), embeds))
+                lines = []
+                embeds = []
+
+            lines.append(text)
+            embeds.append(embed)
+
+        if embeds:
+            messages.append(('\n'.join(lines), embeds))
+
+        return messages
+
+
+    @staticmethod
+    def _digest_line(text: str, embed: discord.Embed) -> str:
+        fields = {field.name: field.value for field in embed.fields}
+        line = f'{text} **{embed.title}**'
+        if 'Difficulty' in fields:
+            line += f' ({fields["Difficulty"]})'
+        if 'Score' in fields:
+            line += f': {fields["Score"]}'
+        return line
+
+
+    @staticmethod
+    def digest(records: List[tuple[str, discord.Embed]]) -> List[str]:
+        '''
+        Summarize records as one line each, split into messages that fit Discord's length limit
+        '''
+        messages: List[str] = []
+        current = f'{len(records)} new high scores:'
+
+        for (text, embed) in records:
+            line = Announcer._digest_line(text, embed)[:_MAX_CONTENT]
+            if len(current) + len(line) + 1 > _MAX_CONTENT:
+                messages.append(current)
+                current = line
+            else:
+                current += f'\n{line}'
+
+        messages.append(current)
+        return messages
+
+
+    def _enqueue(self, channel: discord.abc.Messageable, content: str | None, embeds: List[discord.Embed]):
+        key = getattr(channel, 'id', id(channel))
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = asyncio.Queue()
+            self._queues[key] = queue
+            self._workers[key] = asyncio.ensure_future(self._send_loop(channel, queue))
+
+        queue.put_nowait((content, embeds))
+
+
+    async def _send_loop(self, channel: discord.abc.Messageable, queue: 'asyncio.Queue[tuple[str | None, List[discord.Embed]]]'):
+        while True:
+            (content, embeds) = await queue.get()
+            try:
+                await channel.send(content=content, embeds=embeds)
+            except discord.HTTPException as ex:
+                metrics.DISCORD_SEND_ERRORS.inc()
+                _LOG.warning(f'Failed to post high scores: {ex}')
+            except Exception as ex:
+                metrics.DISCORD_SEND_ERRORS.inc()
+                _LOG.exception(ex)
+            finally:
+                queue.task_done()
+
+            if not queue.empty():
+                _LOG.debug(f'{queue.qsize()} announcements waiting')
+            await asyncio.sleep(self.interval)
+
+
+    def send(self, channel: discord.abc.Messageable, content: str):
+        '''
+        Queue a plain text message behind any announcements already waiting for the channel
+        '''
+        self._enqueue(channel, content, [])
+
+
+    def announce(self, channel: discord.abc.Messageable, records: List[tuple[str, discord.Embed]], quiet: bool = False):
+        '''
+        Queue new high scores to be posted to a channel. With `quiet`, only the number of records
+        is posted.
+        '''
+        if len(records) <= 0:
+            return
+
+        if quiet:
+            self._enqueue(channel, f'{len(records)} new high scores.', [])
+        elif len(records) > self.digest_threshold:
+            for content in self.digest(records):
+                self._enqueue(channel, content, [])
+        else:
+            for (content, embeds) in self.pack(records):
+                self._enqueue(channel, content, embeds)
+
+
+    async def flush(self):
+        '''
+        Wait for every queued announcement to be sent
+        '''
+        await asyncio.gather(*[queue.join() for queue in self._queues.values()])
+
+
+    def close(self):
+        for worker in self._workers.values():
+            worker.cancel()
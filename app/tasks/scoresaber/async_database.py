@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Tuple, TypeVar
+
+from peewee import BaseQuery
+
+import metrics
+
+from .database import BackfillJob, BeatsaverMap, Database, Player, Score
+
+_LOG = logging.getLogger('discord-util').getChild('scoresaber').getChild('async_database')
+
+T = TypeVar('T')
+
+
+class _PoolStats:
+    '''
+    Queue depth and latency counters for one of the database thread pools
+    '''
+    pending: int = 0
+    queries: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            'pending': self.pending,
+            'queries': self.queries,
+            'avg_ms': round(self.total_time / self.queries * 1000, 2) if self.queries else 0.0,
+            'max_ms': round(self.max_time * 1000, 2),
+        }
+
+
+class AsyncDatabase:
+    '''
+    Runs `Database` queries off the event loop so slow queries don't stall the bot.
+
+    Writes are serialized through a single writer thread, and reads are spread over a small pool
+    of reader threads. Every thread gets its own SQLite connection, and the database runs in WAL
+    mode so readers aren't blocked while the writer is busy.
+    '''
+    database: Database
+
+    _writer: ThreadPoolExecutor
+    _readers: ThreadPoolExecutor
+    _reader_count: int
+    _stats: Dict[str, _PoolStats]
+
+    def __init__(self, database: Database, readers: int = 2):
+        self.database = database
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='scoresaber-db-writer')
+        self._reader_count = max(1, readers)
+        self._readers = ThreadPoolExecutor(max_workers=self._reader_count, thread_name_prefix='scoresaber-db-reader')
+        self._stats = {'read': _PoolStats(), 'write': _PoolStats()}
+
+
+    @staticmethod
+    def _timed(fn: Callable[..., T], *args, **kwargs) -> Tuple[T, float]:
+        '''
+        Run a query in a pool thread and time it. Lazy peewee queries are evaluated here so no SQL
+        runs once the result is back on the event loop.
+        '''
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        if isinstance(result, BaseQuery):
+            result = list(result)
+        return (result, time.perf_counter() - start)
+
+
+    async def _submit(self, kind: str, pool: ThreadPoolExecutor, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        # Counters are only touched from the event loop, so they don't need a lock
+        stats = self._stats[kind]
+        stats.pending += 1
+        try:
+            (result, elapsed) = await asyncio.get_running_loop().run_in_executor(pool, lambda: self._timed(fn, *args, **kwargs))
+        finally:
+            stats.pending -= 1
+
+        stats.queries += 1
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        metrics.DATABASE_SECONDS.observe(elapsed, method=getattr(fn, '__name__', 'unknown'))
+        return result
+
+
+    async def read(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        '''
+        Run a read-only query on the reader pool
+        '''
+        return await self._submit('read', self._readers, fn, *args, **kwargs)
+
+
+    async def write(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        '''
+        Run a query that modifies the database on the writer thread
+        '''
+        return await self._submit('write', self._writer, fn, *args, **kwargs)
+
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        '''
+        Queue depth and query latency for the reader and writer pools
+        '''
+        return {kind: stats.as_dict() for (kind, stats) in self._stats.items()}
+
+
+    def close(self):
+        '''
+        Stop the database threads once any queued queries have finished. Every thread's connection
+        is closed, and the WAL is checkpointed back into the database file so it is complete on its
+        own once the bot has stopped.
+        '''
+        # Connections are per thread, so each reader has to close its own. The barrier holds every
+        # reader until they have all picked up a task, so no thread gets two and misses out another
+        barrier = threading.Barrier(self._reader_count)
+        closing = [self._readers.submit(self._close_reader, barrier) for _ in range(self._reader_count)]
+        for future in closing:
+            future.result()
+        self._writer.submit(self._close_writer).result()
+
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self.database.db.close()
+
+
+    def _close_reader(self, barrier: threading.Barrier):
+        barrier.wait()
+        self.database.db.close()
+
+
+    def _close_writer(self):
+        # Readers are closed by now, so the checkpoint can copy every frame and empty the WAL
+        try:
+            self.database.db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+        except Exception as ex:
+            _LOG.exception(ex)
+        self.database.db.close()
+
+
+    async def get_players(self, guild_id: str | None = None) -> List[Player]:
+        return await self.read(self.database.get_players, guild_id)
+
+    async def create_player(self, steam_id: str, discord_id: str | None, scoresaber_id: str, guild_id: str | None = None, known_guilds: Iterable[str] = ()) -> Player:
+        return await self.write(self.database.create_player, steam_id, discord_id, scoresaber_id, guild_id, known_guilds)
+
+    async def get_player_guilds(self) -> Dict[str, List[str]]:
+        return await self.read(self.database.get_player_guilds)
+
+    async def update_scores(self, scores: List[dict]) -> List[Tuple[Score | None, int | None]]:
+        return await self.write(self.database.update_scores, scores)
+
+    async def get_beatsaver_maps(self, song_hashes: List[str]) -> Dict[str, BeatsaverMap]:
+        return await self.read(self.database.get_beatsaver_maps, song_hashes)
+
+    async def set_beatsaver_maps(self, map_ids: Dict[str, str | None], fetched_at: float):
+        return await self.write(self.database.set_beatsaver_maps, map_ids, fetched_at)
+
+    async def queue_backfill(self, players: List[str], queued_at: float) -> int:
+        return await self.write(self.database.queue_backfill, players, queued_at)
+
+    async def get_backfill_jobs(self) -> List[BackfillJob]:
+        return await self.read(self.database.get_backfill_jobs)
+
+    async def get_backfill_job(self, player: str) -> BackfillJob:
+        return await self.read(self.database.get_backfill_job, player)
+
+    async def next_backfill_job(self) -> BackfillJob | None:
+        return await self.read(self.database.next_backfill_job)
+
+    async def record_backfill_failure(self, player: str, error: str, retries: int, now: float) -> bool:
+        return await self.write(self.database.record_backfill_failure, player, error, retries, now)
+
+    async def get_player_scores(self, player: str, limit: int = 100, guild_id: str | None = None) -> List[Score]:
+        return await self.read(self.database.get_player_scores, player, limit, guild_id)
+
+    async def get_song_scores(self, song_hash: str, difficulty: int) -> List[Score]:
+        return await self.read(self.database.get_song_scores, song_hash, difficulty)
+
+    async def get_player_progress(self, player: str, since: float) -> List[tuple[str, int, int, int | None, float]]:
+        return await self.read(self.database.get_player_progress, player, since)
+
+    async def get_most_improved(self, since: float, limit: int = 10, guild_id: str | None = None) -> List[tuple[str, str | None, int, int, int]]:
+        return await self.read(self.database.get_most_improved, since, limit, guild_id)
+
+    async def get_top_search(self, search_str: str, guild_id: str | None = None) -> List[Score]:
+        return await self.read(self.database.get_top_search, search_str, guild_id)
+
+    async def get_high_scores(self) -> List[Score]:
+        return await self.read(self.database.get_high_scores)
+
+    async def rebuild_top_scores(self) -> int:
+        return await self.write(self.database.rebuild_top_scores)
@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import logging
+import time
+from typing import Awaitable, Callable, Deque, List, NamedTuple
+
+from .async_database import AsyncDatabase
+from .database import BackfillJob, Player, Score
+from .updater import ScoreUpdater
+
+_LOG = logging.getLogger('discord-util').getChild('scoresaber').getChild('backfill')
+
+# How far back throughput is measured for the ETA
+_RATE_WINDOW = 600.0
+
+
+class BackfillStatus(NamedTuple):
+    '''
+    Progress of every crawl, for the status command
+    '''
+    jobs: List[BackfillJob]
+    scores_per_minute: float
+    eta: float | None
+
+
+class BackfillRunner:
+    '''
+    Imports players' full score history in the background.
+
+    Crawls are queued per player in the database and worked through one page at a time, oldest
+    queued first. Each page is written in the same transaction as the crawl's next page number, so
+    after a restart the crawl picks up from the first page it hadn't finished. Scores set during a
+    crawl push older scores onto later pages, so a resumed crawl may read some scores twice, which
+    is harmless, but never skips any.
+
+    Crawls run at a lower priority than regular updates: only one page is fetched at a time, with
+    `page_delay` seconds between pages, and each request waits until `reserve` requests would
+    still be left in the rate limit so regular updates aren't held up.
+
+    A crawl finishes on a short or empty page, or once it has read as many scores as ScoreSaber
+    says the player has. Failed pages are counted on the crawl, and after `retries` failures in
+    a row it goes to the back of the queue so the other crawls aren't stuck behind it.
+    '''
+    database: AsyncDatabase
+    updater: ScoreUpdater
+    page_size: int
+    page_delay: float
+    reserve: int
+    retries: int
+    on_finished: Callable[[BackfillJob], Awaitable[None]] | None
+
+    _wake: asyncio.Event
+    _progress: Deque[tuple[float, int]]
+
+    def __init__(self,
+                 database: AsyncDatabase,
+                 updater: ScoreUpdater,
+                 page_delay: float = 1.0,
+                 reserve: int = 100,
+                 page_size: int = 100,
+                 retries: int = 5,
+                 on_finished: Callable[[BackfillJob], Awaitable[None]] | None = None):
+        self.database = database
+        self.updater = updater
+        self.page_delay = page_delay
+        self.reserve = max(0, reserve)
+        self.retries = max(1, retries)
+        self.page_size = page_size
+        self.on_finished = on_finished
+        self._wake = asyncio.Event()
+        self._progress = collections.deque()
+
+
+    async def queue(self, steam_ids: List[str]) -> int:
+        '''
+        Queue a crawl for each player and wake the runner. Returns the number of crawls queued
+        '''
+        queued = await self.database.queue_backfill(steam_ids, time.time())
+        self._wake.set()
+        return queued
+
+
+    def _checkpoint(self, player: str, page: int, scores: int, total: int | None, finished: bool) -> Callable[[List[List[tuple[Score | None, int | None]]]], None]:
+        def save(written: List[List[tuple[Score | None, int | None]]]):
+            records = sum(1 for results in written for (new_high, _) in results if new_high is not None)
+            self.database.database.save_backfill_progress(player, page + 1, scores, total, records, time.time() if finished else None)
+        return save
+
+
+    async def _step(self, job: BackfillJob) -> bool:
+        '''
+        Fetch and write the next page of a crawl. Returns False if the page couldn't be fetched
+        '''
+        player: Player = job.player
+        fetched = await self.updater.fetch_page(player, job.next_page, self.page_size, self.reserve)
+        if fetched is None:
+            return False
+
+        (scores, total) = fetched
+        steam_id = str(player.steam_id)
+        # A player whose score count is a multiple of the page size has no short last page
+        finished = len(scores) < self.page_size or (total is not None and job.scores_done + len(scores) >= total)
+        checkpoint = self._checkpoint(steam_id, job.next_page, len(scores), total, finished)
+
+        if scores:
+            await self.updater.ingest([(player, wrapper.leaderboard, wrapper.score) for wrapper in scores], checkpoint)
+        else:
+            await self.database.write(checkpoint, [])
+
+        self._progress.append((time.monotonic(), len(scores)))
+        _LOG.debug(f'Backfilled page {job.next_page} for {steam_id}: {len(scores)} scores')
+
+        if finished:
+            _LOG.info(f'Finished backfilling {steam_id}')
+            if self.on_finished is not None:
+                await self.on_finished(await self.database.get_backfill_job(steam_id))
+
+        return True
+
+
+    async def run(self):
+        '''
+        Work through queued crawls until cancelled
+        '''
+        failures = 0
+        while True:
+            job = await self.database.next_backfill_job()
+            if job is None:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+
+            error = None
+            try:
+                if not await self._step(job):
+                    error = f'Could not fetch page {job.next_page}'
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                _LOG.exception(ex)
+                error = f'{type(ex).__name__}: {ex}'
+
+            if error is not None:
+                steam_id = str(job.player.steam_id)
+                if await self.database.record_backfill_failure(steam_id, error, self.retries, time.time()):
+                    _LOG.warning(f'Backfill for {steam_id} failed {self.retries} times in a row, moving it to the back of the queue: {error}')
+
+            # Back off while ScoreSaber is failing rather than hammering it
+            failures = 0 if error is None else failures + 1
+            await asyncio.sleep(self.page_delay * (2 ** min(failures, 6)))
+
+
+    def _scores_per_second(self) -> float:
+        now = time.monotonic()
+        while self._progress and now - self._progress[0][0] > _RATE_WINDOW:
+            self._progress.popleft()
+
+        if len(self._progress) < 2:
+            return 0.0
+
+        # The first page marks the start of the window, so its scores aren't counted in it
+        elapsed = now - self._progress[0][0]
+        return sum(scores for (_, scores) in list(self._progress)[1:]) / elapsed if elapsed > 0 else 0.0
+
+
+    async def status(self) -> BackfillStatus:
+        '''
+        Progress of every crawl, with the recent throughput and an estimate of the time left for
+        the crawls that have started
+        '''
+        jobs = await self.database.get_backfill_jobs()
+        rate = self._scores_per_second()
+
+        # Crawls that haven't fetched a page yet don't know their total, so aren't counted
+        remaining = sum(max(0, (job.scores_total or 0) - job.scores_done) for job in jobs if not job.done)
+        eta = remaining / rate if rate > 0 else None
+
+        return BackfillStatus(jobs, rate * 60, eta)
@@ -0,0 +1,172 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+import aiohttp
+
+from . import beatsaver_api_url, beatsaver_maps_url
+from .async_database import AsyncDatabase
+
+_LOG = logging.getLogger('discord-util').getChild('scoresaber').getChild('beatsaver')
+
+
+class BeatsaverCache:
+    '''
+    Resolves song hashes to BeatSaver map URLs.
+
+    Lookups go through an in-memory LRU first, then the `BeatsaverMap` table in the scoresaber
+    database, and only then to the BeatSaver API. Songs BeatSaver doesn't know about (404) are
+    cached as misses for `negative_ttl` seconds so they are retried eventually. Found maps never
+    expire since a hash always points to the same map. Uncached hashes are looked up in batches
+    using BeatSaver's comma-separated hash lookup.
+    '''
+    database: AsyncDatabase
+    max_size: int
+    negative_ttl: float
+    batch_size: int
+
+    hits: int = 0
+    misses: int = 0
+
+    _entries: 'OrderedDict[str, tuple[str | None, float]]'
+
+    def __init__(self, database: AsyncDatabase, max_size: int = 1024, negative_ttl: float = 86400.0, batch_size: int = 50):
+        self.database = database
+        self.max_size = max(1, max_size)
+        self.negative_ttl = negative_ttl
+        self.batch_size = max(1, batch_size)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+
+    @staticmethod
+    def map_url(map_id: str | None) -> str | None:
+        '''
+        Build the public BeatSaver URL for a map ID
+        '''
+        if map_id is None:
+            return None
+        return f'{beatsaver_maps_url}/{map_id}'
+
+
+    def _expired(self, map_id: str | None, fetched_at: float) -> bool:
+        return map_id is None and time.time() - fetched_at > self.negative_ttl
+
+
+    def _remember(self, song_hash: str, map_id: str | None, fetched_at: float):
+        self._entries[song_hash] = (map_id, fetched_at)
+        self._entries.move_to_end(song_hash)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+    def lookup(self, song_hash: str) -> tuple[bool, str | None]:
+        '''
+        Look up a song hash in memory only. Returns whether the hash was found in the cache, and
+        the map ID if BeatSaver has one.
+        '''
+        entry = self._entries.get(song_hash.upper())
+        if entry is not None and not self._expired(*entry):
+            self._entries.move_to_end(song_hash.upper())
+            return (True, entry[0])
+
+        return (False, None)
+
+
+    async def store(self, map_ids: Dict[str, str | None]):
+        '''
+        Record lookup results from BeatSaver in both cache tiers
+        '''
+        fetched_at = time.time()
+        for (song_hash, map_id) in map_ids.items():
+            self._remember(song_hash, map_id, fetched_at)
+        await self.database.set_beatsaver_maps(map_ids, fetched_at)
+
+
+    async def _fetch(self, session: aiohttp.ClientSession, hashes: List[str]) -> Dict[str, str | None] | None:
+        '''
+        Look up a chunk of hashes on BeatSaver in a single request. Returns None if the request
+        failed, in which case nothing is cached and the hashes are tried again next time.
+        '''
+        beatsaver_search_url = f'{beatsaver_api_url}/maps/hash/{",".join(hashes)}'
+        _LOG.log(level = 5, msg = f'GET {beatsaver_search_url}')
+        try:
+            async with session.get(beatsaver_search_url) as b:
+                if len(hashes) == 1 and b.status == 404:
+                    return {hashes[0]: None}
+
+                if b.status != 200:
+                    _LOG.debug(f'Bad return status from BeatSaver {b.status} {b.reason}')
+                    return None
+
+                beatsaver_json = await b.json()
+        except aiohttp.ClientError as ex:
+            _LOG.warning(f'Error looking up maps on BeatSaver: {ex}')
+            return None
+
+        # A single hash returns the map itself, multiple hashes return a map (or null) per hash
+        if len(hashes) == 1:
+            return {hashes[0]: str(beatsaver_json['id'])}
+
+        found = {key.upper(): value for (key, value) in beatsaver_json.items()}
+        return {song_hash: str(found[song_hash]['id']) if found.get(song_hash) else None for song_hash in hashes}
+
+
+    async def resolve(self, session: aiohttp.ClientSession, hashes: Iterable[str]) -> Dict[str, str | None]:
+        '''
+        Get the BeatSaver map URLs for many song hashes at once. Anything not already cached is
+        fetched from BeatSaver `batch_size` hashes per request.
+        '''
+        urls: Dict[str, str | None] = {}
+        unknown: List[str] = []
+
+        for song_hash in dict.fromkeys(song_hash.upper() for song_hash in hashes):
+            (found, map_id) = self.lookup(song_hash)
+            if found:
+                urls[song_hash] = self.map_url(map_id)
+            else:
+                unknown.append(song_hash)
+
+        if unknown:
+            stored = await self.database.get_beatsaver_maps(unknown)
+            missing: List[str] = []
+            for song_hash in unknown:
+                entry = stored.get(song_hash)
+                if entry is not None and not self._expired(entry.map_id, entry.fetched_at):
+                    self._remember(song_hash, entry.map_id, entry.fetched_at)
+                    urls[song_hash] = self.map_url(entry.map_id)
+                else:
+                    missing.append(song_hash)
+            unknown = missing
+
+        self.hits += len(urls)
+        self.misses += len(unknown)
+
+        if unknown:
+            _LOG.debug(f'Resolving {len(unknown)} hashes from BeatSaver')
+
+        for i in range(0, len(unknown), self.batch_size):
+            chunk = unknown[i:i + self.batch_size]
+            fetched = await self._fetch(session, chunk)
+            if fetched is not None:
+                await self.store(fetched)
+            for song_hash in chunk:
+                urls[song_hash] = self.map_url(fetched.get(song_hash) if fetched is not None else None)
+
+        return urls
+
+
+    async def get_url(self, session: aiohttp.ClientSession, song_hash: str) -> str | None:
+        '''
+        Get the BeatSaver map URL for a song hash, fetching it from BeatSaver if it isn't cached
+        '''
+        return (await self.resolve(session, [song_hash]))[song_hash.upper()]
+
+
+    def stats(self) -> dict[str, int]:
+        '''
+        Cache counters for logging
+        '''
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
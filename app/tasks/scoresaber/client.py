@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, NamedTuple
+
+import aiohttp
+from multidict import CIMultiDictProxy
+
+import metrics
+
+_LOG = logging.getLogger('discord-util').getChild('scoresaber').getChild('client')
+
+# orjson decodes large score pages several times faster than the standard library, but it's optional
+try:
+    import orjson
+    json_loads: Callable[[bytes], Any] = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+class ScoresaberResponse(NamedTuple):
+    '''
+    The parts of a ScoreSaber response the callers need. `data` is the decoded JSON for a 200
+    '''
+    status: int
+    reason: str | None
+    data: Any
+
+
+class RateLimiter:
+    '''
+    Token bucket following ScoreSaber's `x-ratelimit-*` headers.
+
+    Tokens refill evenly over `window` seconds up to `limit`. Each response corrects the bucket
+    with what the server says is left, and once the server reports nothing remaining no more
+    requests are sent until the reset time it gave.
+    '''
+    limit: int
+    window: float
+    tokens: float
+
+    _updated: float
+    _blocked_until: float
+    _lock: asyncio.Lock
+
+    def __init__(self, limit: int = 400, window: float = 60.0):
+        self.limit = limit
+        self.window = window
+        self.tokens = float(limit)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(float(self.limit), self.tokens + (now - self._updated) * self.limit / self.window)
+        self._updated = now
+
+
+    async def acquire(self, reserve: int = 0):
+        '''
+        Wait until a request is allowed to be sent. With `reserve`, first wait until there would
+        still be that many requests left over, so background work leaves room for everything else.
+        '''
+        reserve = min(reserve, self.limit - 1)
+        while reserve > 0:
+            # Waits outside the lock so requests without a reserve can go ahead meanwhile
+            self._refill()
+            if self.tokens - reserve >= 1:
+                break
+            await asyncio.sleep(max(self._blocked_until - time.monotonic(), (reserve + 1 - self.tokens) * self.window / self.limit))
+
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = self._blocked_until - time.monotonic()
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = max(wait, (1 - self.tokens) * self.window / self.limit)
+                _LOG.debug(f'Rate limited, waiting {wait:.2f}s')
+                await asyncio.sleep(wait)
+
+
+    def block_for(self, seconds: float):
+        '''
+        Hold off all requests for a while, e.g. after a 429
+        '''
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+    def update(self, headers: 'CIMultiDictProxy[str]'):
+        '''
+        Correct the bucket from the rate limit headers on a response
+        '''
+        try:
+            if 'x-ratelimit-limit' in headers:
+                self.limit = max(1, int(headers['x-ratelimit-limit']))
+
+            if 'x-ratelimit-remaining' in headers:
+                self._refill()
+                remaining = int(headers['x-ratelimit-remaining'])
+                self.tokens = min(self.tokens, float(remaining))
+
+                if remaining <= 0 and 'x-ratelimit-reset' in headers:
+                    self.block_for(float(headers['x-ratelimit-reset']) - time.time())
+        except ValueError:
+            _LOG.debug(f'Could not parse rate limit headers: {dict(headers)}')
+
+
+class ScoresaberClient:
+    '''
+    Shared HTTP client for the ScoreSaber API.
+
+    Requests wait on a `RateLimiter` before they are sent, 429 and 5xx responses are retried with
+    jittered exponential backoff, and concurrent requests for the same URL share one request.
+    '''
+    retries: int
+    backoff: float
+    limiter: RateLimiter
+
+    _session: aiohttp.ClientSession | None
+    _inflight: Dict[str, 'asyncio.Task[ScoresaberResponse]']
+
+    def __init__(self, retries: int = 3, backoff: float = 1.0, limiter: RateLimiter | None = None):
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self._session = None
+        self._inflight = {}
+
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Sessions have to be created from inside the event loop, so this can't happen in __init__
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(trace_configs=[metrics.http_trace()])
+        return self._session
+
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+    def _delay(self, attempt: int) -> float:
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+    async def _fetch(self, url: str, reserve: int) -> ScoresaberResponse:
+        attempt = 0
+        while True:
+            await self.limiter.acquire(reserve)
+            _LOG.log(level = 5, msg = f'GET {url}')
+
+            try:
+                async with self._get_session().get(url) as r:
+                    self.limiter.update(r.headers)
+
+                    if r.status == 200:
+                        return ScoresaberResponse(r.status, r.reason, json_loads(await r.read()))
+
+                    if (r.status != 429 and r.status < 500) or attempt >= self.retries:
+                        return ScoresaberResponse(r.status, r.reason, None)
+
+                    delay = self._delay(attempt)
+                    if r.status == 429:
+                        retry_after = r.headers.get('retry-after')
+                        if retry_after is not None and retry_after.isdigit():
+                            delay = max(delay, float(retry_after))
+                        self.limiter.block_for(delay)
+
+                    _LOG.debug(f'Got {r.status} {r.reason} from {url}, retrying in {delay:.2f}s')
+
+            except aiohttp.ClientError as ex:
+                if attempt >= self.retries:
+                    raise
+                delay = self._delay(attempt)
+                _LOG.debug(f'Error fetching {url}: {ex}, retrying in {delay:.2f}s')
+
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+    async def get(self, url: str, reserve: int = 0) -> ScoresaberResponse:
+        '''
+        GET a ScoreSaber URL. If the same URL is already being fetched, wait for that request
+        instead of sending another. `reserve` lowers the request's priority; see
+        `RateLimiter.acquire`.
+        '''
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(url, reserve))
+            self._inflight[url] = task
+            task.add_done_callback(lambda done: self._inflight.pop(url) if self._inflight.get(url) is done else None)
+
+        # Shielded so one caller giving up doesn't cancel the request for everyone else
+        return await asyncio.shield(task)
@@ -1,12 +1,20 @@
 import logging
-from typing import List, Tuple
+import re
+import time
+from typing import Dict, Iterable, List, NamedTuple, Tuple
 from enum import Enum
 
 from peewee import (SQL, CharField, ForeignKeyField, IntegerField, Model,
-                    SqliteDatabase, fn, AutoField, TextField)
+                    SqliteDatabase, fn, AutoField, BooleanField, TextField, FloatField, Field,
+                    EXCLUDED, chunked, CompositeKey, Select, IntegrityError, Case)
+from peewee import Tuple as SqlTuple
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.sqlite_ext import FTS5Model, SearchField
 
 from bot_config import ScoresaberConfig
 
+from .migrations import Migration, run_migrations
+
 _LOG = logging.getLogger('discord-util').getChild('scoresaber').getChild('database')
 
 # Uncomment these to see DB queries
@@ -31,6 +39,19 @@ class Player(BaseModel):
     steam_id = CharField(primary_key=True)
     discord_id = CharField(null=True)
     scoresaber_id = CharField(unique=True, null=False)
+    last_score_id = IntegerField(null=True)
+    last_time_set = CharField(null=True)
+
+
+class GuildPlayer(BaseModel):
+    '''
+    Which guilds track which players. Players that aren't in any guild are tracked by all of them
+    '''
+    guild_id = CharField(null=False)
+    player = ForeignKeyField(Player, backref='guilds')
+
+    class Meta:
+        primary_key = CompositeKey('guild_id', 'player')
 
 
 class Score(BaseModel):
@@ -43,15 +64,99 @@ class Score(BaseModel):
     song_mapper = CharField()
     song_hash = CharField(null=False)
     difficulty = IntegerField(null=False)
-    player = ForeignKeyField(Player, backref='player')
+    # Indexed together with the score by the migrations
+    player = ForeignKeyField(Player, backref='player', index=False)
     score = IntegerField(null=False)
     image_url = TextField()
-    beatsaver_url = TextField()
+    beatsaver_url = TextField(null=True)
 
     class Meta:
         constraints = [SQL('UNIQUE(song_hash, difficulty, player_id)')]
 
 
+class ScoreHistory(BaseModel):
+    '''
+    Every improvement recorded to a player's score on a song, with when it was set. Rows are only
+    ever added, so progress can be read back without asking ScoreSaber again.
+    '''
+    id = AutoField()
+    player = ForeignKeyField(Player, backref='history', index=False)
+    song_hash = CharField(null=False)
+    difficulty = IntegerField(null=False)
+    score = IntegerField(null=False)
+    previous = IntegerField(null=True)
+    set_at = FloatField(null=False)
+
+    class Meta:
+        indexes = (
+            (('player', 'set_at'), False),
+            (('set_at', 'player', 'score', 'previous'), False),
+        )
+
+
+class TopScore(BaseModel):
+    '''
+    The current best score for each song and difficulty, kept up to date as scores are recorded
+    '''
+    song_hash = CharField(null=False)
+    difficulty = IntegerField(null=False)
+    score = IntegerField(null=False)
+    record = ForeignKeyField(Score, backref='top')
+
+    class Meta:
+        primary_key = CompositeKey('song_hash', 'difficulty')
+
+
+class SongSearch(FTS5Model):
+    '''
+    Full-text index of song names, artists and mappers. One row per song hash
+    '''
+    song_hash = SearchField(unindexed=True)
+    song_name = SearchField()
+    song_artist = SearchField()
+    song_mapper = SearchField()
+
+    class Meta:
+        database = database
+        options = {'tokenize': 'unicode61 remove_diacritics 2'}
+
+
+class BackfillJob(BaseModel):
+    '''
+    A crawl through a player's whole score history, with how far it has got so it can carry on
+    after a restart
+    '''
+    player = ForeignKeyField(Player, primary_key=True, backref='backfill')
+    done = BooleanField(default=False)
+    next_page = IntegerField(default=1)
+    scores_done = IntegerField(default=0)
+    scores_total = IntegerField(null=True)
+    records = IntegerField(default=0)
+    queued_at = FloatField(null=False)
+    finished_at = FloatField(null=True)
+    # Failed tries at the next page since the last one that worked
+    attempts = IntegerField(default=0)
+    last_error = TextField(null=True)
+
+
+class BeatsaverMap(BaseModel):
+    '''
+    Cached BeatSaver lookup for a song hash. A null map_id records that BeatSaver has no map for the hash
+    '''
+    song_hash = CharField(primary_key=True)
+    map_id = CharField(null=True)
+    fetched_at = FloatField(null=False)
+
+
+class LeaderboardEntry(NamedTuple):
+    '''
+    A single player's score on a song and difficulty
+    '''
+    score: int
+    steam_id: str
+    discord_id: str | None
+
+
 class Difficulty(Enum):
     '''
     Translate numeric difficulty as tracked by scoresaber
@@ -86,102 +191,497 @@ class Database:
     '''
     db = database
 
+    # Rows per statement for bulk queries, kept well below SQLite's bound variable limit
+    _BATCH_SIZE = 100
+
     def __init__(self, cfg: ScoresaberConfig):
         '''
-        Initialize the database object. Creates tables if necessary.
+        Initialize the database object. Creates tables and applies any new migrations.
         '''
-        database.init(cfg.database)
+        database.init(cfg.database, pragmas={'journal_mode': 'wal'})
+
+        run_migrations(self.db, [
+            Migration(1, 'initial schema', self._create_schema),
+            Migration(2, 'score indexes', self._create_score_indexes),
+            Migration(3, 'backfill jobs', lambda: self.db.create_tables([BackfillJob])),
+            Migration(4, 'backfill failures', lambda: self._add_missing_columns(BackfillJob, [BackfillJob.attempts, BackfillJob.last_error])),
+            Migration(5, 'missing map links', self._clear_missing_map_links),
+        ])
 
+    def _create_schema(self):
+        '''
+        Create the tables. Databases made before migrations were tracked may already have some of
+        them, so each one is checked and older tables are brought up to date.
+        '''
         if not self.db.table_exists('player'):
             self.db.create_tables([Player, Score])
 
-    def get_players(self) -> List[Player]:
+        if not self.db.table_exists('guildplayer'):
+            self.db.create_tables([GuildPlayer])
+
+        if not self.db.table_exists('beatsavermap'):
+            self.db.create_tables([BeatsaverMap])
+
+        self._add_missing_columns(Player, [Player.last_score_id, Player.last_time_set])
+
+        if not self.db.table_exists('songsearch'):
+            self._create_song_search()
+
+        if not self.db.table_exists('scorehistory'):
+            self.db.create_tables([ScoreHistory])
+
+        if not self.db.table_exists('topscore'):
+            self.db.create_tables([TopScore])
+            self.rebuild_top_scores()
+
+    def _create_score_indexes(self):
+        '''
+        Index scores by player and by song, both in score order, so listing a player's or a song's
+        scores doesn't need a table scan and sort
         '''
-        Get the list of all players
+        for index in [Score.index(Score.player, Score.score.desc(), safe=True),
+                      Score.index(Score.song_hash, Score.difficulty, Score.score.desc(), safe=True)]:
+            self.db.execute(index)
+
+        # Covered by the player and score index
+        self.db.execute_sql('DROP INDEX IF EXISTS score_player_id')
+
+    def _clear_missing_map_links(self):
         '''
-        return Player.select()
+        Songs with no BeatSaver link used to be stored with the text 'None' as their link. Let the
+        column be null and clear those.
 
-    def create_player(self, steam_id: str, discord_id: str | None, scoresaber_id: str) -> Player:
+        SQLite can't drop a NOT NULL constraint in place, so older score tables are copied into a
+        new table without it, with every other column, constraint and index kept as they were.
+        '''
+        (table_sql,) = self.db.execute_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'score'").fetchone()
+        if '"beatsaver_url" TEXT NOT NULL' in table_sql:
+            index_sql = [sql for (sql,) in self.db.execute_sql("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'score' AND sql IS NOT NULL")]
+            self.db.execute_sql(table_sql.replace('CREATE TABLE "score"', 'CREATE TABLE "score_new"', 1)
+                                         .replace('"beatsaver_url" TEXT NOT NULL', '"beatsaver_url" TEXT'))
+            self.db.execute_sql('INSERT INTO "score_new" SELECT * FROM "score"')
+            self.db.execute_sql('DROP TABLE "score"')
+            self.db.execute_sql('ALTER TABLE "score_new" RENAME TO "score"')
+            for sql in index_sql:
+                self.db.execute_sql(sql)
+
+        count = Score.update(beatsaver_url=None).where(Score.beatsaver_url == 'None').execute()
+        _LOG.info(f'Cleared {count} missing map links')
+
+    def _create_song_search(self):
+        '''
+        Create the full-text song index and fill it from any scores already recorded
+        '''
+        with self.db.atomic():
+            self.db.create_tables([SongSearch])
+            songs = Score.select(Score.song_hash, Score.song_name, Score.song_artist, Score.song_mapper) \
+                .group_by(Score.song_hash)
+            SongSearch.insert_from(songs, [SongSearch.song_hash, SongSearch.song_name, SongSearch.song_artist, SongSearch.song_mapper]) \
+                .execute()
+
+    def _add_missing_columns(self, model: type[BaseModel], fields: List[Field]):
         '''
-        Create a new player in the database
+        Add columns to tables created by older versions of the bot
         '''
-        Player.create(steam_id=steam_id, discord_id=discord_id, scoresaber_id=scoresaber_id)
-        return Player.get_by_id(steam_id)
+        table = model._meta.table_name
+        existing = [column.name for column in self.db.get_columns(table)]
+        migrator = SqliteMigrator(self.db)
+        missing = [migrator.add_column(table, field.column_name, field) for field in fields if field.column_name not in existing]
 
-    def update_score(self,
-                     player: str,
-                     song_hash: str,
-                     difficulty: int,
-                     score: int,
-                     song_name: str,
-                     song_artist: str = '',
-                     song_mapper: str = '',
-                     image_url: str | None = None,
-                     beatsaver_url: str | None = None) -> Tuple[Score | None, int | None]:
+        if missing:
+            _LOG.info(f'Adding {len(missing)} new columns to {table}')
+            migrate(*missing)
+
+    def get_players(self, guild_id: str | None = None) -> List[Player]:
+        '''
+        Get the list of all players, or only the players tracked by one guild
         '''
-        Create or update a high score for a specific song by a player.
+        if guild_id is None:
+            return Player.select()
 
-        If a record doesn't exist, create a new high score for a song. If a record exists,
-        update it if the new score is higher. Returns true if the score was created or updated,
-        false otherwise.
+        return Player.select().where(self._in_guild(guild_id))
+
+    @staticmethod
+    def _in_guild(guild_id: str, player: Field = Player.steam_id):
+        '''
+        Condition matching the players a guild tracks, including players in no guild. `player` is
+        the column holding the steam ID to check
         '''
+        members = GuildPlayer.select(GuildPlayer.player).where(GuildPlayer.guild_id == guild_id)
+        assigned = GuildPlayer.select(GuildPlayer.player)
+        return player.in_(members) | player.not_in(assigned)
+
+    def create_player(self,
+                      steam_id: str,
+                      discord_id: str | None,
+                      scoresaber_id: str,
+                      guild_id: str | None = None,
+                      known_guilds: Iterable[str] = ()) -> Player:
+        '''
+        Create a new player in the database and add them to a guild's roster. A player that is
+        already registered by another guild is shared rather than created again. Raises
+        `IntegrityError` if the player is already registered (in that guild).
 
-        # Find if there is already a score for this player in the table
-        old_score = Score.select() \
-            .where((Score.player == player) & (Score.song_hash == song_hash) & (Score.difficulty == difficulty)) \
-            .order_by(Score.score.desc()) \
-            .limit(1)
+        A player in no guild is tracked by every guild, so before one is added to a guild's
+        roster they are added to every guild in `known_guilds` too, and no guild loses sight of
+        them.
+        '''
+        with self.db.atomic():
+            (player, created) = Player.get_or_create(steam_id=steam_id,
+                                                     defaults={'discord_id': discord_id, 'scoresaber_id': scoresaber_id})
 
-        if len(old_score): # Score already recorded
-            _LOG.log(level = 5, msg = f'Found old score of {old_score[0].score} for {player} on {song_name}')
+            if guild_id is None:
+                if not created:
+                    raise IntegrityError(f'{steam_id} is already registered')
+            else:
+                if GuildPlayer.select().where((GuildPlayer.guild_id == guild_id) & (GuildPlayer.player == player)).exists():
+                    raise IntegrityError(f'{steam_id} is already registered in guild {guild_id}')
 
-            # Default: score wasn't higher than one already in the database
-            retval = None
-            old_pb = None
+                guilds = [guild_id]
+                if not created and not GuildPlayer.select().where(GuildPlayer.player == player).exists():
+                    guilds += [known for known in dict.fromkeys(known_guilds) if known != guild_id]
 
-            if old_score[0].image_url != image_url:
-                old_score[0].image_url = image_url
+                GuildPlayer.insert_many([{'guild_id': guild, 'player': player} for guild in guilds]).execute()
 
-            if old_score[0].beatsaver_url != beatsaver_url:
-                old_score[0].beatsaver_url = beatsaver_url
+        return player
 
-            if score > old_score[0].score: # Is it higher than what we have?
-                old_pb = old_score[0].score
-                old_score[0].score = score
-                retval = old_score[0]
+    def get_player_guilds(self) -> Dict[str, List[str]]:
+        '''
+        Get the guilds tracking each player, keyed by steam ID. Players in no guild are left out
+        '''
+        guilds: Dict[str, List[str]] = {}
+        for (player, guild_id) in GuildPlayer.select(GuildPlayer.player, GuildPlayer.guild_id).tuples():
+            guilds.setdefault(player, []).append(guild_id)
+        return guilds
 
-            old_score[0].save()
-            return (retval, old_pb)
+    def set_player_cursor(self, player: str, score_id: int, time_set: str):
+        '''
+        Record the newest score fetched for a player so later updates can stop once they reach it
+        '''
+        Player.update(last_score_id=score_id, last_time_set=time_set).where(Player.steam_id == player).execute()
 
-        else: # New song
-            return (Score.create(song_hash=song_hash,
-                            player=player,
-                            score=score,
-                            difficulty=difficulty,
-                            song_name=song_name,
-                            song_artist=song_artist,
-                            song_mapper=song_mapper,
-                            image_url=image_url,
-                            beatsaver_url=beatsaver_url), None)
+    def update_scores(self, scores: List[dict]) -> List[Tuple[Score | None, int | None]]:
+        '''
+        Create or update many high scores at once.
+
+        Each entry needs `player`, `song_hash`, `difficulty`, `score` and `song_name`, and may have
+        `song_artist`, `song_mapper`, `image_url`, `beatsaver_url` and `set_at`. All of the scores
+        are written in one transaction with a conditional upsert, so only rows with a higher score
+        (or new map links) are touched. Returns one entry per score in the same order: the updated
+        Score if it is a new PB (None otherwise), and the previous PB if there was one. Each new
+        high score is also added to the score history in the same transaction, using the entry's
+        `set_at` (unix time) if it has one.
+        '''
+        if not scores:
+            return []
+
+        # The same song and difficulty can show up more than once (e.g. different game modes), so
+        # only the best of those is written
+        best: Dict[tuple[str, str, int], dict] = {}
+        for entry in scores:
+            key = (str(entry['player']), entry['song_hash'], entry['difficulty'])
+            if key not in best or entry['score'] > best[key]['score']:
+                best[key] = entry
+
+        keys = list(best.keys())
+        with self.db.atomic():
+            previous: Dict[tuple[str, str, int], int] = {}
+            for chunk in chunked(keys, self._BATCH_SIZE):
+                query = Score.select(Score.player, Score.song_hash, Score.difficulty, Score.score) \
+                    .where(SqlTuple(Score.player, Score.song_hash, Score.difficulty).in_(chunk)) \
+                    .tuples()
+                for (player, song_hash, difficulty, score) in query:
+                    previous[(player, song_hash, difficulty)] = score
+
+            # Songs seen for the first time need adding to the search index
+            new_songs: Dict[str, dict] = {}
+            for chunk in chunked(list(dict.fromkeys(key[1] for key in keys if key not in previous)), self._BATCH_SIZE):
+                known = {song_hash for (song_hash,) in Score.select(Score.song_hash).where(Score.song_hash.in_(chunk)).distinct().tuples()}
+                for key in keys:
+                    if key[1] in chunk and key[1] not in known:
+                        new_songs.setdefault(key[1], best[key])
+
+            rows = [{
+                'player': key[0],
+                'song_hash': key[1],
+                'difficulty': key[2],
+                'score': best[key]['score'],
+                'song_name': best[key]['song_name'],
+                'song_artist': best[key].get('song_artist', ''),
+                'song_mapper': best[key].get('song_mapper', ''),
+                'image_url': best[key].get('image_url'),
+                'beatsaver_url': best[key].get('beatsaver_url'),
+            } for key in keys]
+
+            for chunk in chunked(rows, self._BATCH_SIZE):
+                Score.insert_many(chunk) \
+                    .on_conflict(
+                        conflict_target=[Score.song_hash, Score.difficulty, Score.player],
+                        update={
+                            Score.score: fn.MAX(Score.score, EXCLUDED.score),
+                            Score.image_url: EXCLUDED.image_url,
+                            # A failed BeatSaver lookup doesn't clear a link found before
+                            Score.beatsaver_url: fn.COALESCE(EXCLUDED.beatsaver_url, Score.beatsaver_url),
+                        },
+                        where=((EXCLUDED.score > Score.score) |
+                               (EXCLUDED.image_url != Score.image_url) |
+                               (EXCLUDED.beatsaver_url.is_null(False) &
+                                (Score.beatsaver_url.is_null() | (EXCLUDED.beatsaver_url != Score.beatsaver_url))))) \
+                    .execute()
+
+            self._index_songs(new_songs.values())
+
+            improved = [key for key in keys if key not in previous or best[key]['score'] > previous[key]]
+            updated: Dict[tuple[str, str, int], Score] = {}
+            for chunk in chunked(improved, self._BATCH_SIZE):
+                query = Score.select(Score, Player) \
+                    .join(Player) \
+                    .where(SqlTuple(Score.player, Score.song_hash, Score.difficulty).in_(chunk))
+                for score in query:
+                    updated[(score.player.steam_id, score.song_hash, score.difficulty)] = score
+
+            self._update_top_scores(updated.values())
+            self._record_history([(score, previous.get(key), best[key].get('set_at')) for (key, score) in updated.items()])
+
+        _LOG.debug(f'Upserted {len(rows)} scores, {len(updated)} new high scores')
+
+        results: List[Tuple[Score | None, int | None]] = []
+        for entry in scores:
+            key = (str(entry['player']), entry['song_hash'], entry['difficulty'])
+            if best[key] is entry and key in updated:
+                results.append((updated[key], previous.get(key)))
+            else:
+                results.append((None, None))
+
+        return results
+
+
+    def _update_top_scores(self, scores: Iterable[Score]):
+        '''
+        Make any of these scores that beat the recorded best for their song the new top score
+        '''
+        rows = [{
+            'song_hash': score.song_hash,
+            'difficulty': score.difficulty,
+            'score': score.score,
+            'record': score.id,
+        } for score in scores]
+
+        for chunk in chunked(rows, self._BATCH_SIZE):
+            TopScore.insert_many(chunk) \
+                .on_conflict(
+                    conflict_target=[TopScore.song_hash, TopScore.difficulty],
+                    update={TopScore.score: EXCLUDED.score, TopScore.record: EXCLUDED.record_id},
+                    where=(EXCLUDED.score > TopScore.score)) \
+                .execute()
+
+
+    def _record_history(self, improvements: Iterable[Tuple[Score, int | None, float | None]]):
+        '''
+        Append new high scores to the score history as (score, previous score, set_at) tuples
+        '''
+        now = time.time()
+        rows = [{
+            'player': score.player_id,
+            'song_hash': score.song_hash,
+            'difficulty': score.difficulty,
+            'score': score.score,
+            'previous': previous,
+            'set_at': set_at if set_at is not None else now,
+        } for (score, previous, set_at) in improvements]
+
+        for chunk in chunked(rows, self._BATCH_SIZE):
+            ScoreHistory.insert_many(chunk).execute()
+
+
+    def rebuild_top_scores(self) -> int:
+        '''
+        Recompute the top score for every song from the Score table. Returns the number of songs
+        '''
+        ranked = Score.select(
+                Score.song_hash,
+                Score.difficulty,
+                Score.score,
+                Score.id,
+                fn.ROW_NUMBER().over(
+                    partition_by=[Score.song_hash, Score.difficulty],
+                    order_by=[Score.score.desc(), Score.id.asc()]).alias('rk')) \
+            .alias('ranked')
+
+        best = Select([ranked], [ranked.c.song_hash, ranked.c.difficulty, ranked.c.score, ranked.c.id]) \
+            .where(ranked.c.rk == 1)
+
+        with self.db.atomic():
+            TopScore.delete().execute()
+            TopScore.insert_from(best, [TopScore.song_hash, TopScore.difficulty, TopScore.score, TopScore.record]).execute()
+            count = TopScore.select().count()
 
+        _LOG.info(f'Rebuilt top scores for {count} songs')
+        return count
 
-    def get_player_scores(self, player: str, limit: int = 100) -> List[Score]:
+
+    def _index_songs(self, songs: Iterable[dict]):
+        '''
+        Add songs to the full-text search index
+        '''
+        rows = [{
+            'song_hash': song['song_hash'],
+            'song_name': song['song_name'],
+            'song_artist': song.get('song_artist', ''),
+            'song_mapper': song.get('song_mapper', ''),
+        } for song in songs]
+
+        for chunk in chunked(rows, self._BATCH_SIZE):
+            SongSearch.insert_many(chunk).execute()
+
+
+    def get_beatsaver_maps(self, song_hashes: List[str]) -> Dict[str, BeatsaverMap]:
+        '''
+        Get the cached BeatSaver lookups for a list of song hashes, keyed by hash
+        '''
+        maps: Dict[str, BeatsaverMap] = {}
+        for chunk in chunked(song_hashes, self._BATCH_SIZE):
+            for beatsaver_map in BeatsaverMap.select().where(BeatsaverMap.song_hash.in_(chunk)):
+                maps[beatsaver_map.song_hash] = beatsaver_map
+        return maps
+
+
+    def set_beatsaver_maps(self, map_ids: Dict[str, str | None], fetched_at: float):
         '''
-        Get the list of scores for a specific player
+        Record the results of BeatSaver lookups, keyed by song hash
         '''
-        return Score.select().where(Score.player == player).order_by(Score.score.desc()).limit(limit)
+        rows = [{'song_hash': song_hash, 'map_id': map_id, 'fetched_at': fetched_at} for (song_hash, map_id) in map_ids.items()]
+        with self.db.atomic():
+            for chunk in chunked(rows, self._BATCH_SIZE):
+                BeatsaverMap.replace_many(chunk).execute()
+
+
+    def queue_backfill(self, players: List[str], queued_at: float) -> int:
+        '''
+        Queue a full history crawl for each player. Players with a crawl already underway keep
+        their progress, and finished crawls start again. Returns the number of crawls queued.
+        '''
+        rows = [{'player': player, 'queued_at': queued_at} for player in players]
+        with self.db.atomic():
+            before = BackfillJob.select().where(BackfillJob.done == False).count()
+            for chunk in chunked(rows, self._BATCH_SIZE):
+                BackfillJob.insert_many(chunk) \
+                    .on_conflict(
+                        conflict_target=[BackfillJob.player],
+                        update={
+                            BackfillJob.done: False,
+                            BackfillJob.next_page: 1,
+                            BackfillJob.scores_done: 0,
+                            BackfillJob.scores_total: None,
+                            BackfillJob.records: 0,
+                            BackfillJob.queued_at: EXCLUDED.queued_at,
+                            BackfillJob.finished_at: None,
+                            BackfillJob.attempts: 0,
+                            BackfillJob.last_error: None,
+                        },
+                        where=(BackfillJob.done == True)) \
+                    .execute()
+            after = BackfillJob.select().where(BackfillJob.done == False).count()
+
+        return after - before
+
+    def get_backfill_jobs(self) -> List[BackfillJob]:
+        '''
+        Get every crawl, unfinished ones first and then in the order they were queued
+        '''
+        return BackfillJob.select(BackfillJob, Player) \
+            .join(Player) \
+            .order_by(BackfillJob.done, BackfillJob.queued_at, BackfillJob.player)
+
+    def get_backfill_job(self, player: str) -> BackfillJob:
+        '''
+        Get the crawl for one player
+        '''
+        return BackfillJob.select(BackfillJob, Player).join(Player).where(BackfillJob.player == player).get()
+
+    def next_backfill_job(self) -> BackfillJob | None:
+        '''
+        Get the unfinished crawl that was queued first
+        '''
+        return BackfillJob.select(BackfillJob, Player) \
+            .join(Player) \
+            .where(BackfillJob.done == False) \
+            .order_by(BackfillJob.queued_at, BackfillJob.player) \
+            .first()
+
+    def save_backfill_progress(self, player: str, next_page: int, scores: int, total: int | None, records: int, finished_at: float | None = None):
+        '''
+        Record a page of a crawl as done. `scores` and `records` are added to the totals so far.
+        Passing `finished_at` marks the crawl finished.
+        '''
+        BackfillJob.update(
+                next_page=next_page,
+                scores_done=BackfillJob.scores_done + scores,
+                scores_total=fn.COALESCE(total, BackfillJob.scores_total),
+                records=BackfillJob.records + records,
+                done=finished_at is not None,
+                finished_at=finished_at,
+                attempts=0,
+                last_error=None) \
+            .where(BackfillJob.player == player) \
+            .execute()
+
+    def record_backfill_failure(self, player: str, error: str, retries: int, now: float) -> bool:
+        '''
+        Record a failed try at the next page of a crawl. Every `retries` failures in a row the
+        crawl is moved to the back of the queue, so one that keeps failing can't hold up the
+        others. Returns whether it was moved.
+        '''
+        with self.db.atomic():
+            job = BackfillJob.get(BackfillJob.player == player)
+            job.attempts += 1
+            job.last_error = error
+            rotated = job.attempts % max(1, retries) == 0
+            if rotated:
+                job.queued_at = now
+            job.save()
+
+        return rotated
+
+
+    def get_player_scores(self, player: str, limit: int = 100, guild_id: str | None = None) -> List[Score]:
+        '''
+        Get the list of scores for a specific player. With `guild_id`, nothing is returned unless
+        that guild tracks the player.
+        '''
+        query = Score.select().where(Score.player == player)
+        if guild_id is not None:
+            query = query.where(self._in_guild(guild_id, Score.player))
+        return query.order_by(Score.score.desc()).limit(limit)
 
 
     def get_high_scores(self) -> List[Score]:
         '''
         Get the current high-score records
         '''
-        return Score.select(Score, Player, fn.Max(Score.score).alias('high_score')) \
+        return Score.select(Score, Player) \
+                    .join(TopScore, on=(TopScore.record == Score.id)) \
+                    .switch(Score) \
                     .join(Player) \
-                    .group_by(Score.song_hash, Score.difficulty) \
                     .prefetch(Player)
 
 
+    def get_song_leaders(self, songs: Iterable[tuple[str, int]]) -> Dict[tuple[str, int], LeaderboardEntry]:
+        '''
+        Get the current top score for each (song_hash, difficulty) that has one
+        '''
+        leaders: Dict[tuple[str, int], LeaderboardEntry] = {}
+        for chunk in chunked(list(dict.fromkeys(songs)), self._BATCH_SIZE):
+            query = TopScore.select(TopScore.song_hash, TopScore.difficulty, TopScore.score, Player.steam_id, Player.discord_id) \
+                .join(Score, on=(TopScore.record == Score.id)) \
+                .join(Player) \
+                .where(SqlTuple(TopScore.song_hash, TopScore.difficulty).in_(chunk)) \
+                .tuples()
+            for (song_hash, difficulty, score, steam_id, discord_id) in query:
+                leaders[(song_hash, difficulty)] = LeaderboardEntry(score, steam_id, discord_id)
+        return leaders
+
+
     def get_song_scores(self, song_hash: CharField, difficulty: int) -> List[Score]:
         '''
         Get the scores for a particular song
@@ -192,24 +692,87 @@ class Database:
             .order_by(Score.score.desc()) \
             .prefetch(Player)
 
-    def get_top_search(self, search_str: str) -> List[Score]:
+    def get_player_progress(self, player: str, since: float) -> List[tuple[str, int, int, int | None, float]]:
+        '''
+        Get the improvements a player has set since a unix time, oldest first, as
+        (song_name, difficulty, score, previous score, set_at)
+        '''
+        return ScoreHistory.select(Score.song_name, ScoreHistory.difficulty, ScoreHistory.score, ScoreHistory.previous, ScoreHistory.set_at) \
+            .join(Score, on=((Score.player == ScoreHistory.player) &
+                             (Score.song_hash == ScoreHistory.song_hash) &
+                             (Score.difficulty == ScoreHistory.difficulty))) \
+            .where((ScoreHistory.player == player) & (ScoreHistory.set_at >= since)) \
+            .order_by(ScoreHistory.set_at) \
+            .tuples()
+
+    def get_most_improved(self, since: float, limit: int = 10, guild_id: str | None = None) -> List[tuple[str, str | None, int, int, int]]:
         '''
-        Search for songs and return the top score for all difficulties found, if any
+        Rank players by the improvements they have set since a unix time, as (steam_id,
+        discord_id, improvements, new songs, points gained on songs they had played before).
+        With `guild_id`, only players that guild tracks are ranked.
         '''
-        # Alias partitioning from: https://charlesleifer.com/blog/querying-the-top-n-objects-per-group-with-peewee-orm/
-        score_alias = Score.alias()
+        improvements = fn.COUNT(ScoreHistory.id)
+        new_songs = fn.SUM(Case(None, [(ScoreHistory.previous.is_null(), 1)], 0))
+        gained = fn.COALESCE(fn.SUM(ScoreHistory.score - ScoreHistory.previous), 0)
 
-        subquery = (score_alias
-                        .select(score_alias, fn.RANK().over(
-                            partition_by=[score_alias.song_hash, score_alias.difficulty],
-                            order_by=[score_alias.score.desc()]).alias('rk')
-                        ).alias('subq'))
+        query = ScoreHistory.select(Player.steam_id, Player.discord_id, improvements, new_songs, gained) \
+            .join(Player) \
+            .where(ScoreHistory.set_at >= since)
+
+        if guild_id is not None:
+            query = query.where(self._in_guild(guild_id))
+
+        # Grouped on the player table so SQLite reads only the window from the set_at index
+        return query \
+            .group_by(Player.steam_id) \
+            .order_by(improvements.desc(), gained.desc()) \
+            .limit(limit) \
+            .tuples()
+
+    @staticmethod
+    def _search_expression(search_str: str) -> str | None:
+        '''
+        Turn free text into an FTS5 query where every word must prefix-match a word in the song
+        name, artist or mapper
+        '''
+        terms = [term for term in re.findall(r'\w+', search_str)]
+        if not terms:
+            return None
+        return ' '.join(f'"{term}"*' for term in terms)
+
+
+    def get_top_search(self, search_str: str, guild_id: str | None = None) -> List[Score]:
+        '''
+        Search for songs and return the top score for all difficulties found, if any. With
+        `guild_id`, the top score among the players that guild tracks is returned instead.
+        '''
+        expression = self._search_expression(search_str)
+        if expression is None:
+            return []
+
+        songs = SongSearch.select(SongSearch.song_hash).where(SongSearch.match(expression))
+
+        if guild_id is None:
+            return Score.select(Score, Player) \
+                .join(TopScore, on=(TopScore.record == Score.id)) \
+                .switch(Score) \
+                .join(Player) \
+                .where(TopScore.song_hash.in_(songs)) \
+                .order_by(Score.song_name.asc()) \
+                .prefetch(Player)
+
+        # TopScore is across every guild, so the guild's best is ranked from its players' scores
+        ranked = Score.select(
+                Score.id,
+                fn.ROW_NUMBER().over(
+                    partition_by=[Score.song_hash, Score.difficulty],
+                    order_by=[Score.score.desc(), Score.id.asc()]).alias('rk')) \
+            .where(Score.song_hash.in_(songs) & self._in_guild(guild_id, Score.player)) \
+            .alias('ranked')
 
         return Score.select(Score, Player) \
-            .join(Player) \
+            .join(ranked, on=((ranked.c.id == Score.id) & (ranked.c.rk == 1))) \
             .switch(Score) \
-            .join(subquery, on=((subquery.c.id == Score.id) & (subquery.c.rk == 1))) \
-            .where((Score.song_name ** f'%{search_str}%')) \
-            .group_by(Score.song_hash, Score.difficulty) \
+            .join(Player) \
             .order_by(Score.song_name.asc()) \
             .prefetch(Player)
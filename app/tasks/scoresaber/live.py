@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable, Dict, List
+
+import aiohttp
+from pydantic import ValidationError
+
+import metrics
+
+from . import ScoresaberPlayerScore, ScoresaberSlimLeaderboard, ScoresaberSlimScore, scoresaber_ws_url
+from .async_database import AsyncDatabase
+from .client import json_loads
+from .database import Player
+from .updater import NewRecord, ScoreUpdater
+
+_LOG = logging.getLogger('discord-util').getChild('scoresaber').getChild('live')
+
+
+class LiveFeed:
+    '''
+    Follows ScoreSaber's live score websocket and records scores set by registered players.
+
+    Every score anyone sets comes through the feed, so events are filtered on the ScoreSaber IDs
+    of registered players before anything else is done with them. Matching scores go through
+    `ScoreUpdater.ingest` and any new records are passed to `announce`.
+
+    If the connection drops, it reconnects with a growing delay. Scores set while disconnected
+    are never sent, so `reconcile` is called after every reconnect to poll for them.
+    '''
+    database: AsyncDatabase
+    updater: ScoreUpdater
+    url: str
+    announce: Callable[[List[NewRecord]], Awaitable[None]]
+    reconcile: Callable[[], Awaitable[None]]
+    max_delay: float
+
+    _players: Dict[str, Player]
+    _attempt: int
+    _reconciling: asyncio.Future | None
+
+    def __init__(self,
+                 database: AsyncDatabase,
+                 updater: ScoreUpdater,
+                 announce: Callable[[List[NewRecord]], Awaitable[None]],
+                 reconcile: Callable[[], Awaitable[None]],
+                 url: str = scoresaber_ws_url,
+                 max_delay: float = 300.0):
+        self.database = database
+        self.updater = updater
+        self.announce = announce
+        self.reconcile = reconcile
+        self.url = url
+        self.max_delay = max_delay
+        self._players = {}
+        self._attempt = 0
+        self._reconciling = None
+
+
+    async def refresh(self):
+        '''
+        Reload the registered players to filter the feed on
+        '''
+        self._players = {str(player.scoresaber_id): player for player in await self.database.get_players()}
+        _LOG.debug(f'Following live scores for {len(self._players)} players')
+
+
+    def _parse(self, message: str) -> tuple[Player, ScoresaberSlimLeaderboard, ScoresaberSlimScore] | None:
+        '''
+        Pick out score events for registered players. Anything else is ignored
+        '''
+        try:
+            event = json_loads(message)
+        except ValueError:
+            # The server greets new connections in plain text
+            _LOG.log(level = 5, msg = f'Ignoring message: {message}')
+            return None
+
+        if not isinstance(event, dict) or event.get('commandName') != 'score':
+            return None
+
+        data = event.get('commandData') or {}
+        player_id = str(((data.get('score') or {}).get('leaderboardPlayerInfo') or {}).get('id'))
+        player = self._players.get(player_id)
+        if player is None:
+            return None
+
+        try:
+            played = ScoresaberPlayerScore.model_validate(data)
+        except ValidationError as ex:
+            _LOG.warning(f'Could not read live score for {player.steam_id}: {ex}')
+            return None
+
+        return (player, played.leaderboard, played.score)
+
+
+    async def _listen(self, session: aiohttp.ClientSession):
+        async with session.ws_connect(self.url, heartbeat=30.0) as ws:
+            _LOG.info(f'Connected to live scores at {self.url}')
+            self._attempt = 0
+            await self.refresh()
+
+            # Runs alongside the feed so a long poll doesn't hold up live scores
+            if self._reconciling is None or self._reconciling.done():
+                self._reconciling = asyncio.ensure_future(self.reconcile())
+
+            async for message in ws:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    event = self._parse(message.data)
+                    if event is not None:
+                        _LOG.debug(f'Live score from {event[0].steam_id} on {event[1].songName}')
+                        records = await self.updater.ingest([event])
+                        if records:
+                            await self.announce(records)
+                elif message.type == aiohttp.WSMsgType.ERROR:
+                    break
+
+
+    async def run(self):
+        '''
+        Follow the feed until cancelled, reconnecting whenever the connection drops
+        '''
+        async with aiohttp.ClientSession(trace_configs=[metrics.http_trace()]) as session:
+            while True:
+                try:
+                    await self._listen(session)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as ex:
+                    _LOG.warning(f'Live score connection failed: {ex}')
+
+                delay = min(self.max_delay, 2 ** self._attempt) * random.uniform(0.5, 1.0)
+                self._attempt += 1
+                _LOG.info(f'Reconnecting to live scores in {delay:.1f}s')
+                await asyncio.sleep(delay)
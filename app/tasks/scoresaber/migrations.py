@@ -0,0 +1,44 @@
+import logging
+from typing import Callable, List, NamedTuple
+
+from peewee import SqliteDatabase
+
+_LOG = logging.getLogger('discord-util').getChild('scoresaber').getChild('migrations')
+
+
+class Migration(NamedTuple):
+    '''
+    One step in the database schema's history. `apply` makes the change; versions must be unique
+    and only ever added to, since databases remember the last version they applied.
+    '''
+    version: int
+    name: str
+    apply: Callable[[], None]
+
+
+def schema_version(db: SqliteDatabase) -> int:
+    '''
+    The last migration applied to a database, 0 for a new database or one made before migrations
+    '''
+    return db.pragma('user_version')
+
+
+def run_migrations(db: SqliteDatabase, migrations: List[Migration]) -> int:
+    '''
+    Apply every migration newer than the database's schema version, in order. Each one runs in
+    its own transaction along with the version bump, so a failed migration leaves the database at
+    the previous version to be retried on the next start. Returns the new schema version.
+    '''
+    version = schema_version(db)
+
+    for migration in sorted(migrations, key=lambda migration: migration.version):
+        if migration.version <= version:
+            continue
+
+        _LOG.info(f'Migrating database to version {migration.version}: {migration.name}')
+        with db.atomic():
+            migration.apply()
+            db.pragma('user_version', migration.version)
+        version = migration.version
+
+    return version
@@ -0,0 +1,122 @@
+import heapq
+import logging
+import time
+from typing import Dict, Iterable, List, NamedTuple
+
+_LOG = logging.getLogger('discord-util').getChild('scoresaber').getChild('scheduler')
+
+# Players due this soon are checked now, so one due just after an update starts isn't left for
+# the next update
+_SLACK = 1.0
+
+
+class ScheduleEntry(NamedTuple):
+    '''
+    When a player will next be checked for new scores, and how often they are being checked
+    '''
+    steam_id: str
+    next_poll: float
+    interval: float
+
+
+class PollScheduler:
+    '''
+    Decides which players to check for new scores on each update.
+
+    Every player has their own polling interval. It drops to `min_interval` as soon as they set a
+    new score, and grows by `backoff` times on each check that finds nothing, up to
+    `max_interval`. At most `budget` players are checked per update (0 for no limit), most
+    overdue first, so the request rate stays bounded however many players are registered.
+    '''
+    min_interval: float
+    max_interval: float
+    backoff: float
+    budget: int
+
+    _entries: Dict[str, ScheduleEntry]
+    _queue: List[tuple[float, str]]
+    _checked: Dict[str, float]
+
+    def __init__(self, min_interval: float = 60.0, max_interval: float = 1800.0, backoff: float = 2.0, budget: int = 0):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = max(1.0, backoff)
+        self.budget = max(0, budget)
+        self._entries = {}
+        self._queue = []
+        self._checked = {}
+
+
+    def _push(self, entry: ScheduleEntry):
+        self._entries[entry.steam_id] = entry
+        heapq.heappush(self._queue, (entry.next_poll, entry.steam_id))
+
+
+    def sync(self, steam_ids: Iterable[str]):
+        '''
+        Match the schedule to the registered players. New players are due straight away
+        '''
+        now = time.time()
+        current = set(steam_ids)
+
+        for steam_id in current - self._entries.keys():
+            self._push(ScheduleEntry(steam_id, now, self.min_interval))
+
+        for steam_id in self._entries.keys() - current:
+            # Anything left in the queue for them is skipped when it comes up
+            del self._entries[steam_id]
+            self._checked.pop(steam_id, None)
+
+
+    def due(self) -> List[str]:
+        '''
+        Take the players that should be checked now. They are put back in the queue at their
+        current interval in case the check fails, and `record` moves them once it's done.
+        '''
+        now = time.time()
+        players: List[str] = []
+
+        while self._queue and self._queue[0][0] <= now + _SLACK and (self.budget == 0 or len(players) < self.budget):
+            (next_poll, steam_id) = heapq.heappop(self._queue)
+            entry = self._entries.get(steam_id)
+
+            # Skip queue entries that were replaced or belong to removed players, and repeats of
+            # the same entry
+            if entry is None or entry.next_poll != next_poll or steam_id in players:
+                continue
+
+            players.append(steam_id)
+
+        for steam_id in players:
+            interval = self._entries[steam_id].interval
+            self._push(ScheduleEntry(steam_id, now + interval, interval))
+            self._checked[steam_id] = now
+
+        return players
+
+
+    def record(self, steam_id: str, active: bool):
+        '''
+        Schedule the next check for a player after they were checked. The interval counts from
+        when `due` handed them out rather than from when the check finished, so it lines up with
+        the updates, which also run on a fixed interval.
+        '''
+        checked = self._checked.pop(steam_id, None)
+        entry = self._entries.get(steam_id)
+        if entry is None:
+            return
+
+        if active:
+            interval = self.min_interval
+        else:
+            interval = min(self.max_interval, entry.interval * self.backoff)
+
+        _LOG.log(level = 5, msg = f'Next check for {steam_id} in {interval}s')
+        self._push(ScheduleEntry(steam_id, (checked if checked is not None else time.time()) + interval, interval))
+
+
+    def schedule(self) -> List[ScheduleEntry]:
+        '''
+        The current schedule for every player, soonest first
+        '''
+        return sorted(self._entries.values(), key=lambda entry: entry.next_poll)
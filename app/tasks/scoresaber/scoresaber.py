@@ -1,19 +1,27 @@
-import aiohttp
+import asyncio
 import config
 import discord
 from discord.ext import tasks
 import discord.ext.commands as commands
 import logging
+import time
 from peewee import IntegrityError
-from typing import cast
+from typing import Dict, List
 
 from bot_config import ScoresaberConfig
 
 from ..task import Task
 
 from . import scoresaber_url
-from .database import Database, Difficulty, Score
-from .updater import ScoreUpdater
+from .announcer import Announcer
+from .async_database import AsyncDatabase
+from .backfill import BackfillRunner
+from .beatsaver import BeatsaverCache
+from .client import ScoresaberClient
+from .database import BackfillJob, Database, Difficulty, Score
+from .live import LiveFeed
+from .scheduler import PollScheduler
+from .updater import NewRecord, ScoreUpdater
 
 _LOG = logging.getLogger('discord-util').getChild("scoresaber")
 
@@ -43,15 +51,36 @@ def _format_score(score: Score) -> str:
     return result
 
 class Scoresaber(Task, commands.Cog):
-    database: Database
+    database: AsyncDatabase
+    beatsaver: BeatsaverCache
+    client: ScoresaberClient
+    scheduler: PollScheduler
     updater: ScoreUpdater
+    live: LiveFeed | None
+    announcer: Announcer
+    backfill_runner: BackfillRunner
+    _live_task: asyncio.Future | None = None
+    _backfill_task: asyncio.Future | None = None
+    _reconciling: asyncio.Lock
 
     def __init__(self, bot: commands.Bot, cfg: ScoresaberConfig):
         Task.__init__(self, bot, cfg)
         Scoresaber._CFG = cfg
 
-        self.database = Database(cfg)
-        self.updater = ScoreUpdater(self.database)
+        self.database = AsyncDatabase(Database(cfg), cfg.database_readers)
+        self.beatsaver = BeatsaverCache(self.database, cfg.beatsaver_cache_size, cfg.beatsaver_negative_ttl, cfg.beatsaver_batch_size)
+        self.client = ScoresaberClient(cfg.request_retries)
+        self.scheduler = PollScheduler(cfg.poll_min_interval, cfg.poll_max_interval, cfg.poll_backoff, cfg.poll_budget)
+        self.updater = ScoreUpdater(self.database, cfg.update_concurrency, self.beatsaver, self.client, self.scheduler)
+        self.backfill_runner = BackfillRunner(self.database, self.updater, cfg.backfill_page_delay, cfg.backfill_reserve,
+                                              retries=cfg.backfill_retries, on_finished=self._backfill_finished)
+
+
+        self._reconciling = asyncio.Lock()
+        self.announcer = Announcer(cfg.announce_interval)
+        self.live = None
+        if cfg.ingest_mode == 'websocket':
+            self.live = LiveFeed(self.database, self.updater, self._announce, self._reconcile, cfg.websocket_url)
 
 
         @tasks.loop(seconds=Scoresaber._CFG.update_interval)
@@ -59,29 +88,118 @@ class Scoresaber(Task, commands.Cog):
             '''Periodically check for new scores'''
             _LOG.debug('Checking for new scores')
 
-            # Fetch the channel and ensure it is a text channel only
-            channel = self.bot.get_channel(Scoresaber._CFG.channels[0])
-            if not type(channel) is discord.TextChannel:
-                pass
-
-            channel = cast(discord.TextChannel, channel)
+            players = await self.database.get_players()
+            self.scheduler.sync(str(player.steam_id) for player in players)
+            due = self.scheduler.due()
+            if not due:
+                return
 
-            with self.database.db:
-                new_scores = await self.updater.update()
+            _LOG.debug(f'Checking {len(due)} of {len(players)} players')
+            new_scores = await self.updater.update(only=due)
 
             _LOG.debug(f'Found {len(new_scores)} new high scores')
-            if len(new_scores) > 0:
-                for (score, embed) in new_scores:
-                    await channel.send(score)
-                    await channel.send(embed=embed)
+            await self._announce(new_scores)
+
+
+        @tasks.loop(seconds=Scoresaber._CFG.reconcile_interval)
+        async def reconcile():
+            '''Occasionally poll every player to catch anything the live feed missed'''
+            await self._reconcile()
+
+        # With the live feed, polling is only needed to fill in gaps
+        self._run = run if self.live is None else reconcile
+
+
+    def run(self):
+        Task.run(self)
+        self._backfill_task = asyncio.ensure_future(self.backfill_runner.run())
+        if self.live is not None:
+            self._live_task = asyncio.ensure_future(self.live.run())
+
+
+    def _announce_channels(self) -> Dict[str, discord.TextChannel]:
+        '''The announcement channel for each guild: the first configured channel in that guild'''
+        channels: Dict[str, discord.TextChannel] = {}
+        for channel_id in Scoresaber._CFG.channels:
+            channel = self.bot.get_channel(channel_id)
+            if isinstance(channel, discord.TextChannel):
+                channels.setdefault(str(channel.guild.id), channel)
+        return channels
+
+
+    @staticmethod
+    def _for_guild(new_scores: List[NewRecord], guild_id: str, guilds: Dict[str, List[str]]) -> List[tuple[str, discord.Embed]]:
+        '''
+        Pick the records for players a guild tracks. Players in no guild are tracked by all of
+        them. Records that beat a player the guild doesn't track are posted without mentioning them.
+        '''
+        def tracked(steam_id: str) -> bool:
+            return steam_id not in guilds or guild_id in guilds[steam_id]
+
+        records: List[tuple[str, discord.Embed]] = []
+        for record in new_scores:
+            if not tracked(record.steam_id):
+                continue
+            if record.beaten is not None and record.without_beaten is not None and not tracked(record.beaten):
+                records.append(record.without_beaten)
+            else:
+                records.append((record.text, record.embed))
+        return records
+
+
+    async def _announce(self, new_scores: List[NewRecord], skip_guild: str | None = None):
+        '''Post new high scores to the announcement channel of every guild tracking the player'''
+        if len(new_scores) <= 0:
+            return
+
+        guilds = await self.database.get_player_guilds()
+        for (guild_id, channel) in self._announce_channels().items():
+            if guild_id != skip_guild:
+                self.announcer.announce(channel, self._for_guild(new_scores, guild_id, guilds))
+
+
+    async def _backfill_finished(self, job: BackfillJob):
+        '''Let the guilds tracking a player know their history has been imported'''
+        steam_id = str(job.player.steam_id)
+        guilds = await self.database.get_player_guilds()
+        message = f'Finished importing the score history for {steam_id}: {job.scores_done} scores, {job.records} new high scores.'
+
+        for (guild_id, channel) in self._announce_channels().items():
+            if steam_id not in guilds or guild_id in guilds[steam_id]:
+                self.announcer.send(channel, message)
+
 
-        self._run = run
+    async def _reconcile(self):
+        '''Check every player for scores, e.g. after the live feed reconnects'''
+        if self._reconciling.locked():
+            return
+
+        async with self._reconciling:
+            _LOG.debug('Reconciling scores for all players')
+            if self.live is not None:
+                await self.live.refresh()
+
+            new_scores = await self.updater.update()
+
+        _LOG.debug(f'Found {len(new_scores)} new high scores')
+        await self._announce(new_scores)
+
+
+    async def cog_unload(self):
+        self._run.cancel()
+        if self._live_task is not None:
+            self._live_task.cancel()
+        if self._backfill_task is not None:
+            self._backfill_task.cancel()
+        await self.client.close()
+        self.announcer.close()
+        self.database.close()
 
 
     @commands.command(
         help='''Update the list of scores recorded in scoresaber
 
-        --force  Force the database to update history from all time
+        --force  Import every player's history from all time. This runs in the background; use !backfill to follow it
         --quiet  Suppres detailed output from this command. The number of scores updated will be printed instead of the list of scores.
         ''',
         usage='[--force] [--quiet]',
@@ -93,20 +211,29 @@ class Scoresaber(Task, commands.Cog):
         force = '--force' in ctx.message.content
         quiet = '--quiet' in ctx.message.content
 
-        with self.database.db:
-            new_records = await self.updater.update(force)
+        guild_id = str(ctx.guild.id) if ctx.guild is not None else None
+
+        if force:
+            players = [str(player.steam_id) for player in await self.database.get_players(guild_id)]
+            queued = await self.backfill_runner.queue(players)
+            await ctx.message.channel.send(f'Importing the full score history for {queued} players in the background. Use `!backfill` to check progress.')
+            return
+
+        new_records = await self.updater.update()
+
+        # Records for this guild are posted here, and any others go to the guilds tracking them
+        if guild_id is not None:
+            records = self._for_guild(new_records, guild_id, await self.database.get_player_guilds())
+        else:
+            records = [(record.text, record.embed) for record in new_records]
+        await self._announce(new_records, skip_guild=guild_id)
 
-        await ctx.message.channel.send('High Scores Updated!')
+        self.announcer.send(ctx.message.channel, 'High Scores Updated!')
 
-        response = ''
-        if len(new_records) <= 0:
-            await ctx.message.channel.send('No new high scores.')
-        elif len(new_records) > 20 or quiet:
-            await ctx.message.channel.send(f'{len(new_records)} new high scores.')
+        if len(records) <= 0:
+            self.announcer.send(ctx.message.channel, 'No new high scores.')
         else:
-            for (score, embed) in new_records:
-                await ctx.message.channel.send(score)
-                await ctx.message.channel.send(embed=embed)
+            self.announcer.announce(ctx.message.channel, records, quiet)
 
 
     @update.error
@@ -118,6 +245,26 @@ class Scoresaber(Task, commands.Cog):
             raise error
 
 
+    @commands.command(
+        help='Recalculate the record holder for every song from all recorded scores',
+        brief='Rebuild the high score records',
+        checks=[_msg_in_channel, _is_power_user],
+    )
+    async def rebuild(self, ctx: commands.Context):
+        _LOG.debug('rebuild requested: %s', ctx.message.content)
+        count = await self.database.rebuild_top_scores()
+        await ctx.message.channel.send(f'Rebuilt high score records for {count} songs.')
+
+
+    @rebuild.error
+    async def rebuild_error(self, ctx: commands.Context, error: commands.CommandError):
+        if isinstance(error, commands.CheckFailure):
+            if _msg_in_channel(ctx):
+                await ctx.message.channel.send('Only power users can use the rebuild command')
+        else:
+            raise error
+
+
     @commands.command(
         help='''Register a new player to the database
 
@@ -155,38 +302,39 @@ class Scoresaber(Task, commands.Cog):
         else:
             discord_id = None
 
-        with self.database.db:
-            async with aiohttp.ClientSession() as session:
-                _LOG.debug(f'Looking up `{steam_id}`')
-                url = f'{scoresaber_url}/players?search={steam_id}'
-                _LOG.debug(f'GET {url}')
-                async with session.get(url) as r:
-                    _LOG.debug(f'Response from server. Code {r.status}')
-
-                    if r.status == 200:
-                        result = await r.json()
-                        if len(result['players']) > 0:
-                            player = result['players'][0]
-                            try:
-                                self.database.create_player(steam_id, discord_id, player['id'])
-                                response = f'{player["name"]} registered!'
-                                _LOG.info(response)
-                                await ctx.message.channel.send(response)
-                                return True
-                            except IntegrityError as ex:
-                                _LOG.exception(ex)
-                                response = f'{steam_id} is already registerd.'
-                                await ctx.message.channel.send(response)
-                                return False
-                            except Exception as ex:
-                                _LOG.exception(ex)
-                                response = f'Failed to register {steam_id}. {ex}'
-                                await ctx.message.channel.send(response)
-                                return False
-
-                    if r.status == 404:
-                        await ctx.message.channel.send(f'Player "{steam_id}" not found')
-                        return False
+        _LOG.debug(f'Looking up `{steam_id}`')
+        r = await self.client.get(f'{scoresaber_url}/players?search={steam_id}')
+        _LOG.debug(f'Response from server. Code {r.status}')
+
+        if r.status == 200:
+            result = r.data
+            if len(result['players']) > 0:
+                player = result['players'][0]
+                try:
+                    guild_id = str(ctx.guild.id) if ctx.guild is not None else None
+                    # Every guild with a channel can see players that aren't in a guild yet
+                    known_guilds = list(self._announce_channels().keys())
+                    await self.database.create_player(steam_id, discord_id, player['id'], guild_id, known_guilds)
+                    if self.live is not None:
+                        await self.live.refresh()
+                    response = f'{player["name"]} registered!'
+                    _LOG.info(response)
+                    await ctx.message.channel.send(response)
+                    return True
+                except IntegrityError as ex:
+                    _LOG.exception(ex)
+                    response = f'{steam_id} is already registerd.'
+                    await ctx.message.channel.send(response)
+                    return False
+                except Exception as ex:
+                    _LOG.exception(ex)
+                    response = f'Failed to register {steam_id}. {ex}'
+                    await ctx.message.channel.send(response)
+                    return False
+
+        if r.status == 404:
+            await ctx.message.channel.send(f'Player "{steam_id}" not found')
+            return False
 
 
     @register.error
@@ -197,6 +345,40 @@ class Scoresaber(Task, commands.Cog):
         else:
             raise error
 
+    @commands.command(
+        help='Show when each player will next be checked for new scores, and how often they are being checked',
+        brief='Show the update schedule',
+        checks=[_msg_in_channel],
+    )
+    async def schedule(self, ctx: commands.Context):
+        '''
+        List the polling schedule for all registered players
+        '''
+        now = time.time()
+        if self.live is not None:
+            # Players aren't polled on their own schedule, only all together by the reconcile loop
+            reply = 'Scores come from the live feed, so players are not polled on a schedule.'
+            next_run = self._run.next_iteration
+            if next_run is not None:
+                reply += f' Every player is next checked in {max(0, round(next_run.timestamp() - now))}s.'
+            await ctx.message.channel.send(reply)
+            return
+
+        reply = 'Update schedule:\n'
+        for entry in self.scheduler.schedule():
+            next_poll = max(0, round(entry.next_poll - now))
+            reply += f'{entry.steam_id}: next check in {next_poll}s, every {round(entry.interval)}s\n'
+
+        await ctx.message.channel.send(reply[:2000])
+
+    @schedule.error
+    async def schedule_error(self, ctx: commands.Context, error: commands.CommandError):
+        if isinstance(error, commands.CheckFailure):
+            return
+        else:
+            raise error
+
+
     @commands.command(
         help='List all the plyers in the database',
         brief='List players',
@@ -204,11 +386,11 @@ class Scoresaber(Task, commands.Cog):
     )
     async def list(self, ctx: commands.Context):
         '''
-        List the steam IDs of all registered players
+        List the steam IDs of the players registered in this guild
         '''
-        with self.database.db:
-            players = [str(player.steam_id) for player in self.database.get_players()]
-            await ctx.message.channel.send(f'Player list: {', '.join(players)}')
+        guild_id = str(ctx.guild.id) if ctx.guild is not None else None
+        players = [str(player.steam_id) for player in await self.database.get_players(guild_id)]
+        await ctx.message.channel.send(f'Player list: {', '.join(players)}')
 
     @list.error
     async def list_error(self, ctx: commands.Context, error: commands.CommandError):
@@ -240,8 +422,8 @@ class Scoresaber(Task, commands.Cog):
         if(len(args) > 1 and args[1] is not None):
             limit = args[1]
 
-        with self.database.db:
-            scores = self.database.get_player_scores(player, limit)
+        guild_id = str(ctx.guild.id) if ctx.guild is not None else None
+        scores = await self.database.get_player_scores(player, limit, guild_id)
 
         if not scores:
             await ctx.message.channel.send(f'No scores found for {player}')
@@ -279,8 +461,8 @@ class Scoresaber(Task, commands.Cog):
             await ctx.message.channel.send('No search string specified')
             return
 
-        with self.database.db:
-            results = self.database.get_top_search(search)
+        guild_id = str(ctx.guild.id) if ctx.guild is not None else None
+        results = await self.database.get_top_search(search, guild_id)
 
         response = f'Top scores for songs matching `{search}`:\n'
         for score in results:
@@ -299,3 +481,132 @@ class Scoresaber(Task, commands.Cog):
             return
         else:
             raise error
+
+
+    @commands.command(
+        help='''Show how a player's scores have improved recently
+
+        <steam_id>  Steam ID of the player
+        [days]      Number of days to look back [Default: 30]''',
+        brief='Show a player\'s progress',
+        usage='<steam_id> [days]',
+        checks=[_msg_in_channel],
+    )
+    async def progress(self, ctx: commands.Context, steam_id: str, days: float = 30):
+        '''
+        List the improvements a player has set over the last few days, from the score history
+        '''
+        history = await self.database.get_player_progress(steam_id, time.time() - days * 86400)
+
+        if not history:
+            await ctx.message.channel.send(f'No new high scores for {steam_id} in the last {days:g} days')
+            return
+
+        gained = sum(score - previous for (_, _, score, previous, _) in history if previous is not None)
+        new_songs = sum(1 for (_, _, _, previous, _) in history if previous is None)
+        reply = f'{steam_id} set {len(history)} new high scores in the last {days:g} days ({new_songs} new songs, +{gained} on songs played before):\n'
+
+        # Most recent first so the newest improvements survive the length limit
+        lines = []
+        for (song_name, difficulty, score, previous, set_at) in reversed(history):
+            day = time.strftime('%Y-%m-%d', time.gmtime(set_at))
+            if previous is None:
+                lines.append(f'{day} {song_name} ({Difficulty(difficulty)}): {score}')
+            else:
+                lines.append(f'{day} {song_name} ({Difficulty(difficulty)}): {previous} -> {score} (+{score - previous})')
+
+        shown = 0
+        for line in lines:
+            if len(reply) + len(line) + 30 > 2000:
+                break
+            reply += f'{line}\n'
+            shown += 1
+
+        if shown < len(lines):
+            reply += f'...and {len(lines) - shown} more'
+
+        await ctx.message.channel.send(reply)
+
+    @progress.error
+    async def progress_error(self, ctx: commands.Context, error: commands.CommandError):
+        if isinstance(error, commands.CheckFailure):
+            return
+        elif isinstance(error, (commands.MissingRequiredArgument, commands.BadArgument)):
+            await ctx.message.channel.send('Invalid progress command. Usage: `!progress <steam_id> [days]`')
+        else:
+            raise error
+
+
+    @commands.command(
+        help='''List the players who have improved the most recently
+
+        [days]  Number of days to look back [Default: 7]''',
+        brief='Show the most improved players',
+        usage='[days]',
+        checks=[_msg_in_channel],
+    )
+    async def improved(self, ctx: commands.Context, days: float = 7):
+        '''
+        Rank players by how many new high scores they have set, from the score history
+        '''
+        guild_id = str(ctx.guild.id) if ctx.guild is not None else None
+        ranking = await self.database.get_most_improved(time.time() - days * 86400, 10, guild_id)
+
+        if not ranking:
+            await ctx.message.channel.send(f'No new high scores in the last {days:g} days')
+            return
+
+        reply = f'Most improved players in the last {days:g} days:\n'
+        for (place, (steam_id, _, improvements, new_songs, gained)) in enumerate(ranking, start=1):
+            reply += f'{place}. {steam_id}: {improvements} new high scores ({new_songs} new songs, +{gained})\n'
+
+        await ctx.message.channel.send(reply)
+
+    @improved.error
+    async def improved_error(self, ctx: commands.Context, error: commands.CommandError):
+        if isinstance(error, commands.CheckFailure):
+            return
+        elif isinstance(error, commands.BadArgument):
+            await ctx.message.channel.send('Invalid improved command. Usage: `!improved [days]`')
+        else:
+            raise error
+
+
+    @commands.command(
+        help='Show the progress of score history imports started with `!update --force`',
+        brief='Show history import progress',
+        checks=[_msg_in_channel],
+    )
+    async def backfill(self, ctx: commands.Context):
+        '''
+        Show progress, throughput and time left for the background history imports
+        '''
+        status = await self.backfill_runner.status()
+        pending = [job for job in status.jobs if not job.done]
+
+        if not pending:
+            await ctx.message.channel.send('No score history imports running.')
+            return
+
+        reply = f'Importing score history for {len(pending)} players at {status.scores_per_minute:.0f} scores/minute'
+        if status.eta is not None:
+            reply += f', about {round(status.eta / 60)} minutes left for the players started so far'
+        reply += ':\n'
+
+        for job in pending:
+            if job.scores_total:
+                percent = min(100, round(job.scores_done / job.scores_total * 100))
+                reply += f'{job.player.steam_id}: {job.scores_done}/{job.scores_total} scores ({percent}%), {job.records} new high scores\n'
+            else:
+                reply += f'{job.player.steam_id}: waiting\n'
+            if job.attempts:
+                reply += f'  failed {job.attempts} times: {job.last_error}\n'
+
+        await ctx.message.channel.send(reply[:2000])
+
+    @backfill.error
+    async def backfill_error(self, ctx: commands.Context, error: commands.CommandError):
+        if isinstance(error, commands.CheckFailure):
+            return
+        else:
+            raise error
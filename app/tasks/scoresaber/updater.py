@@ -1,150 +1,386 @@
+import asyncio
 import logging
-from typing import List
-from . import ScoresaberLeaderboard, ScoresaberScore
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Tuple
+from . import ScoresaberPlayerScore, ScoresaberSlimLeaderboard, ScoresaberSlimScore, player_scores_adapter
 
 import aiohttp
 from discord import Embed
 
-from . import scoresaber_url, beatsaver_api_url, beatsaver_maps_url
-from .database import Database, Score, Difficulty
+import metrics
+
+from . import scoresaber_url
+from .async_database import AsyncDatabase
+from .beatsaver import BeatsaverCache
+from .client import ScoresaberClient
+from .database import Player, Score, Difficulty, LeaderboardEntry
+from .scheduler import PollScheduler
 
 _LOG = logging.getLogger('discord-util').getChild('scoresaber').getChild('updater')
 
-class ScoreUpdater:
-    database: Database
-    _current_high: List[Score] = []
 
-    def __init__(self, database: Database):
+class NewRecord(NamedTuple):
+    '''
+    A new high score ready to announce, and the player who set it. If it took first place from
+    another player, `beaten` is their steam ID and `without_beaten` is the same message without
+    them, for guilds that don't track them.
+    '''
+    steam_id: str
+    text: str
+    embed: Embed
+    beaten: str | None = None
+    without_beaten: tuple[str, Embed] | None = None
+
+
+class ScoreUpdater:
+    database: AsyncDatabase
+    client: ScoresaberClient
+    beatsaver: BeatsaverCache
+    scheduler: PollScheduler | None
+    concurrency: int
+
+    def __init__(self,
+                 database: AsyncDatabase,
+                 concurrency: int = 1,
+                 beatsaver: BeatsaverCache | None = None,
+                 client: ScoresaberClient | None = None,
+                 scheduler: PollScheduler | None = None):
         self.database = database
-        self._current_high = self.database.get_high_scores()
+        self.scheduler = scheduler
+        self.client = client if client is not None else ScoresaberClient()
+        self.beatsaver = beatsaver if beatsaver is not None else BeatsaverCache(database)
+        self.concurrency = max(1, concurrency)
+
+
+    @staticmethod
+    def _already_seen(player: Player, score: ScoresaberSlimScore) -> bool:
+        '''
+        Check a score against the newest score recorded for the player on the last update
+        '''
+        if player.last_time_set is None:
+            return False
+        return (score.timeSet, score.id) <= (player.last_time_set, player.last_score_id or 0)
+
+
+    @staticmethod
+    def _timestamp(time_set: str) -> float | None:
+        '''
+        Convert ScoreSaber's ISO 8601 `timeSet` to unix time
+        '''
+        try:
+            return datetime.fromisoformat(time_set.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            return None
+
+
+    async def _fetch_player(self,
+                            semaphore: asyncio.Semaphore,
+                            player: Player,
+                            limit: int,
+                            force_all: bool) -> tuple[List[tuple[ScoresaberSlimLeaderboard, ScoresaberSlimScore]], bool]:
+        '''
+        Fetch the recent scores for a single player. Only network work happens here so several
+        players can be fetched at once; the database is updated afterwards by the caller.
 
+        Scores are fetched newest first. Unless `force_all` is set, paging stops at the first score
+        that was already seen on a previous update, and carries on to the next page if every score
+        on this one is new. Players that have never been updated only get the first page.
 
-    async def update(self, force_all=False) -> List[tuple[str, Embed]]:
+        Also returns whether every page needed was fetched. If not, the player's high-water mark
+        shouldn't move, so the missing scores are picked up on the next update.
+        '''
+        results: List[tuple[ScoresaberSlimLeaderboard, ScoresaberSlimScore]] = []
+        incremental = not force_all and player.last_time_set is not None
+
+        async with semaphore:
+            _LOG.debug(f'Fetching new scores for {player.steam_id}')
+            page = 1
+            while True:
+                fetched = await self.fetch_page(player, page, limit)
+                if fetched is None:
+                    return (results, False)
+
+                (scores, _) = fetched
+                if len(scores) <= 0:
+                    _LOG.debug(f'No more scores to parse')
+                    break
+
+                caught_up = False
+                for wrapper in scores:
+                    if not force_all and self._already_seen(player, wrapper.score):
+                        caught_up = True
+                        break
+
+                    results.append((wrapper.leaderboard, wrapper.score))
+
+                _LOG.debug(f'Found {len(results)} new scores to parse')
+                page += 1
+
+                if caught_up or (not force_all and not incremental):
+                    break
+
+        return (results, True)
+
+
+    async def fetch_page(self, player: Player, page: int, limit: int, reserve: int = 0) -> tuple[List[ScoresaberPlayerScore], int | None] | None:
+        '''
+        Fetch one page of a player's scores, newest first. Returns the scores on the page and the
+        total number of scores the player has, or None if the request failed. ScoreSaber answers
+        404 for pages past the last one, which comes back as an empty page. `reserve` is passed
+        on to `ScoresaberClient.get`.
+        '''
+        fetch_url = f'{scoresaber_url}/player/{player.scoresaber_id}/scores?sort=recent&limit={limit}&page={page}'
+        try:
+            r = await self.client.get(fetch_url, reserve)
+        except aiohttp.ClientError as ex:
+            _LOG.warning(f'Error fetching scores for {player.steam_id}: {ex}')
+            return None
+
+        if r.status == 404:
+            _LOG.debug(f'No scores on page {page} for {player.steam_id}')
+            return ([], None)
+
+        if r.status != 200:
+            _LOG.warning(f'Bad return status fetching scores for {player.steam_id}: {r.status} {r.reason}')
+            return None
+
+        # Only the fields the updater needs are validated, for the whole page at once
+        scores = player_scores_adapter.validate_python(r.data['playerScores'])
+        total = (r.data.get('metadata') or {}).get('total')
+        return (scores, total)
+
+
+    def _write_scores(self,
+                      players: List[Player],
+                      fetched: List[List[tuple[ScoresaberSlimLeaderboard, ScoresaberSlimScore]]],
+                      complete: List[bool],
+                      beatsaver_urls: Dict[str, str | None],
+                      after: Callable[[List[List[Tuple[Score | None, int | None]]]], None] | None = None) -> tuple[List[List[Tuple[Score | None, int | None]]], Dict[tuple[str, int], LeaderboardEntry]]:
+        '''
+        Write every player's fetched scores in a single transaction. Runs on the database writer
+        thread. Players whose fetch didn't complete keep their old high-water mark. Returns the
+        result of `Database.update_scores` for each player, which is also passed to `after` to
+        make any other changes in the same transaction, and the leader of each song as it was
+        before the scores were written.
+        '''
+        database = self.database.database
+        written: List[List[Tuple[Score | None, int | None]]] = []
+
+        with database.db.atomic():
+            leaders = database.get_song_leaders((board.songHash, board.difficulty.difficulty)
+                                                for results in fetched for (board, _) in results)
+
+            for (player, results, done) in zip(players, fetched, complete):
+                if not results:
+                    written.append([])
+                    continue
+
+                _LOG.log(level = 5, msg = f'Updating {len(results)} new scores for {player.steam_id}')
+                written.append(database.update_scores([{
+                    'player': str(player.steam_id),
+                    'song_hash': board.songHash,
+                    'song_name': board.songName,
+                    'song_artist': board.songAuthorName,
+                    'song_mapper': board.levelAuthorName,
+                    'difficulty': board.difficulty.difficulty,
+                    'score': score.modifiedScore,
+                    'image_url': board.coverImage,
+                    'beatsaver_url': beatsaver_urls.get(board.songHash.upper()),
+                    'set_at': self._timestamp(score.timeSet),
+                } for (board, score) in results]))
+
+                if not done:
+                    continue
+
+                # Remember the newest score seen so the next update can stop there
+                newest = max((score for (_, score) in results), key=lambda score: (score.timeSet, score.id))
+                database.set_player_cursor(str(player.steam_id), newest.id, newest.timeSet)
+
+            if after is not None:
+                after(written)
+
+        return (written, leaders)
+
+
+    @staticmethod
+    def _take_lead(leaders: Dict[tuple[str, int], LeaderboardEntry], score: Score, player: Player) -> LeaderboardEntry | None:
+        '''
+        Check a new high score against the song's leader and make it the leader if it's higher.
+        If it takes first place from another player, the previous leader is returned.
+        '''
+        key = (score.song_hash, score.difficulty)
+        previous = leaders.get(key)
+        if previous is not None and score.score <= previous.score:
+            return None
+
+        leaders[key] = LeaderboardEntry(score.score, str(player.steam_id), player.discord_id)
+        if previous is not None and previous.steam_id != str(player.steam_id):
+            return previous
+
+        return None
+
+
+    async def update(self, force_all=False, only: List[str] | None = None) -> List[NewRecord]:
         '''
         Query scoresaber for new scores and update the database. Returns a list of new records.
+
+        `only` limits the update to the players with those steam IDs. If there is a scheduler, it
+        is told which of the players checked had new scores. Players whose scores couldn't all be
+        fetched aren't counted as checked, so an outage doesn't slow their polling down.
+
+        The update runs in three stages:
+          1. Scores for every player are fetched concurrently (up to `concurrency` at once)
+          2. Song hashes not already known are resolved on BeatSaver in batches
+          3. The results are applied to the database in player order, so the records returned
+             are in the same order regardless of which request completed first
         '''
-        players = self.database.get_players()
+        start = time.perf_counter()
+        players = await self.database.get_players()
+        if only is not None:
+            players = [player for player in players if player.steam_id in only]
         _LOG.debug(f'Found {len(players)} players')
 
         limit = 5 if not force_all else 100
-        new_pbs: List[tuple[Score, ScoresaberLeaderboard, ScoresaberScore, int | None]] = []
-
-        for player in players:
-            async with aiohttp.ClientSession() as session:
-                _LOG.debug(f'Fetching new scores for {player.steam_id}')
-                page = 1
-                while True:
-                    fetch_url = f'{scoresaber_url}/player/{player.scoresaber_id}/scores?sort=recent&limit={limit}&page={page}'
-                    _LOG.log(level = 5, msg = f'GET {fetch_url}')
-                    async with session.get(fetch_url) as r:
-                        if r.status == 200:
-                            json = await r.json()
-                            scores = json['playerScores']
-                            if len(scores) <= 0:
-                                _LOG.debug(f'No more scores to parse')
-                                break
-
-                            _LOG.debug(f'Found {len(scores)} to parse')
-                            for wrapper in scores:
-                                board = ScoresaberLeaderboard.model_validate(wrapper['leaderboard'])
-                                score = ScoresaberScore.model_validate(wrapper['score'])
-
-                                _LOG.log(level = 5, msg = f'Updating new score for {board.songName}')
-                                beatsaver_search_url = f'{beatsaver_api_url}/maps/hash/{board.songHash}'
-                                beatsaver_song_url = None
-                                async with session.get(beatsaver_search_url) as b:
-                                    if b.status == 200:
-                                        beatsaver_json = await b.json()
-                                        beatsaver_song_url = f'{beatsaver_maps_url}/{beatsaver_json['id']}'
-
-                                (new_high, old_pb) = self.database.update_score(
-                                    player=str(player.steam_id),
-                                    song_hash=board.songHash,
-                                    song_name=board.songName,
-                                    song_artist=board.songAuthorName,
-                                    song_mapper=board.levelAuthorName,
-                                    difficulty=board.difficulty.difficulty,
-                                    score=score.modifiedScore,
-                                    image_url=board.coverImage,
-                                    beatsaver_url=str(beatsaver_song_url)
-                                )
-
-                                if new_high and new_high not in new_pbs:
-                                    new_pbs.append((new_high, board, score, old_pb))
-                            page += 1
-
-                        else:
-                            _LOG.debug(f'Bad return status {r.status} {r.reason}')
-                            break
-
-                    if not force_all:
-                        break
-
-        if len(new_pbs):
-            new_overall = self.database.get_high_scores()
 
-            # Get a list of scores where there is a new player in the top slot
-            # The iterator tracks by ID, and since we update existing rows if a player beats their
-            # own high score it won't appear in this list
-            updated_overall = [value for value in new_overall if value not in self._current_high]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        fetches = await asyncio.gather(*[
+            self._fetch_player(semaphore, player, limit, force_all) for player in players
+        ])
+        fetched = [results for (results, _) in fetches]
+        complete = [done for (_, done) in fetches]
 
-            # Save the updated list now we don't need the old scores
-            self._current_high = new_overall
+        if self.scheduler is not None:
+            # Players whose fetch failed stay where `due` put them, at their current interval
+            for (player, results, done) in zip(players, fetched, complete):
+                if done:
+                    self.scheduler.record(str(player.steam_id), len(results) > 0)
 
-            response: List[tuple[str, Embed]] = []
-            for (score, leaderboard, raw_score, old_pb) in new_pbs:
-                score_string = ''
-                embed = Embed(title=score.song_name, url=score.beatsaver_url)
+        records = await self._apply(players, fetched, complete)
 
-                if score.image_url is not None:
-                    embed.set_thumbnail(url=score.image_url)
+        metrics.UPDATE_SECONDS.observe(time.perf_counter() - start, mode='force' if force_all else 'normal')
+        metrics.UPDATE_PLAYERS.inc(len(players))
+        return records
 
-                # Add the mention if there is a discord ID
-                if score.player.discord_id:
-                    score_string = f'<@{score.player.discord_id}>'
-                else:
-                    score_string = score.player.steam_id
 
-                if raw_score.fullCombo:
-                    embed.add_field(name='Full Combo!', value='Great job!', inline=False)
+    async def ingest(self,
+                     scores: List[tuple[Player, ScoresaberSlimLeaderboard, ScoresaberSlimScore]],
+                     after: Callable[[List[List[Tuple[Score | None, int | None]]]], None] | None = None) -> List[NewRecord]:
+        '''
+        Record scores that arrived from somewhere other than a poll, e.g. the live feed or a
+        backfill. Returns a list of new records. `after` is run in the same transaction as the
+        scores are written; see `_write_scores`.
 
-                embed.add_field(name='Score', value=score.score, inline=True)
-                embed.add_field(name='Percent', value=f'{round((raw_score.modifiedScore / leaderboard.maxScore) * 100, 2)}%', inline=True)
-                embed.add_field(name='Difficulty', value=f'{Difficulty(score.difficulty)}', inline=True)
-                embed.add_field(name='Bad Cuts', value=raw_score.badCuts, inline=True)
-                embed.add_field(name='Missed', value=raw_score.missedNotes, inline=True)
+        These don't move the players' high-water marks, so the next poll still picks up anything
+        that was missed before them.
+        '''
+        players: List[Player] = []
+        fetched: List[List[tuple[ScoresaberSlimLeaderboard, ScoresaberSlimScore]]] = []
 
-                if score in updated_overall: # Beat another player
-                    song_leaderboard = self.database.get_song_scores(score.song_hash, leaderboard.difficulty.difficulty)
+        for (player, board, score) in scores:
+            if player not in players:
+                players.append(player)
+                fetched.append([])
+            fetched[players.index(player)].append((board, score))
 
-                    if len(song_leaderboard) > 1:
-                        old_leader = song_leaderboard[1]
-                        embed.add_field(name='Previous High Score', value=old_leader.score, inline=False)
+        return await self._apply(players, fetched, [False] * len(players), after)
 
-                        if old_leader.player.discord_id:
-                            discord_tag = f'<@{old_leader.player.discord_id}>'
-                            score_string += f' beat {discord_tag} and'
-                            embed.add_field(name='Previous Leader', value=discord_tag, inline=True)
-                        else:
-                            steam_id = old_leader.player.steam_id
-                            score_string += f' beat {steam_id} and'
-                            embed.add_field(name='Previous Leader', value=steam_id, inline=True)
 
-                elif old_pb is not None: # New personal best
-                    embed.add_field(name='Previous High Score', value=old_pb, inline=False)
+    async def _apply(self,
+                     players: List[Player],
+                     fetched: List[List[tuple[ScoresaberSlimLeaderboard, ScoresaberSlimScore]]],
+                     complete: List[bool],
+                     after: Callable[[List[List[Tuple[Score | None, int | None]]]], None] | None = None) -> List[NewRecord]:
+        '''
+        Resolve map links for fetched scores, write them to the database, and build the messages
+        for any new records
+        '''
+        new_pbs: List[tuple[Score, ScoresaberSlimLeaderboard, ScoresaberSlimScore, int | None, LeaderboardEntry | None]] = []
 
+        async with aiohttp.ClientSession(trace_configs=[metrics.http_trace()]) as session:
+            song_hashes = [board.songHash for results in fetched for (board, _) in results]
+            beatsaver_urls = await self.beatsaver.resolve(session, song_hashes)
 
-                score_string += f' set a new high score!'
+        (written, leaders) = await self.database.write(self._write_scores, players, fetched, complete, beatsaver_urls, after)
 
-                if score.song_artist:
-                    embed.add_field(name='Artist', value=score.song_artist, inline=False)
+        # Players are taken in order, so a player beating a leader set earlier in this update
+        # is announced as beating them
+        for (player, results, updated) in zip(players, fetched, written):
+            for ((board, score), (new_high, old_pb)) in zip(results, updated):
+                if new_high:
+                    old_leader = self._take_lead(leaders, new_high, player)
+                    new_pbs.append((new_high, board, score, old_pb, old_leader))
 
-                if score.song_mapper:
-                    embed.add_field(name='Mapper', value=score.song_mapper, inline=False)
+        _LOG.debug(f'BeatSaver cache: {self.beatsaver.stats()}')
+        _LOG.debug(f'Database: {self.database.stats()}')
 
-                response.append((score_string, embed))
+        if len(new_pbs):
+            response: List[NewRecord] = []
+            for (score, leaderboard, raw_score, old_pb, old_leader) in new_pbs:
+                (text, embed) = self._message(score, leaderboard, raw_score, old_pb, old_leader)
+                if old_leader is None:
+                    response.append(NewRecord(str(score.player.steam_id), text, embed))
+                else:
+                    response.append(NewRecord(str(score.player.steam_id), text, embed, old_leader.steam_id,
+                                              self._message(score, leaderboard, raw_score, old_pb, None)))
 
             return response
 
         else:
             return []
+
+
+    @staticmethod
+    def _message(score: Score,
+                 leaderboard: ScoresaberSlimLeaderboard,
+                 raw_score: ScoresaberSlimScore,
+                 old_pb: int | None,
+                 old_leader: LeaderboardEntry | None) -> tuple[str, Embed]:
+        '''
+        Build the announcement for a new high score
+        '''
+        score_string = ''
+        embed = Embed(title=score.song_name, url=score.beatsaver_url)
+
+        if score.image_url is not None:
+            embed.set_thumbnail(url=score.image_url)
+
+        # Add the mention if there is a discord ID
+        if score.player.discord_id:
+            score_string = f'<@{score.player.discord_id}>'
+        else:
+            score_string = score.player.steam_id
+
+        if raw_score.fullCombo:
+            embed.add_field(name='Full Combo!', value='Great job!', inline=False)
+
+        embed.add_field(name='Score', value=score.score, inline=True)
+        embed.add_field(name='Percent', value=f'{round((raw_score.modifiedScore / leaderboard.maxScore) * 100, 2)}%', inline=True)
+        embed.add_field(name='Difficulty', value=f'{Difficulty(score.difficulty)}', inline=True)
+        embed.add_field(name='Bad Cuts', value=raw_score.badCuts, inline=True)
+        embed.add_field(name='Missed', value=raw_score.missedNotes, inline=True)
+
+        if old_leader is not None: # Beat another player
+            embed.add_field(name='Previous High Score', value=old_leader.score, inline=False)
+
+            if old_leader.discord_id:
+                discord_tag = f'<@{old_leader.discord_id}>'
+                score_string += f' beat {discord_tag} and'
+                embed.add_field(name='Previous Leader', value=discord_tag, inline=True)
+            else:
+                score_string += f' beat {old_leader.steam_id} and'
+                embed.add_field(name='Previous Leader', value=old_leader.steam_id, inline=True)
+
+        elif old_pb is not None: # New personal best
+            embed.add_field(name='Previous High Score', value=old_pb, inline=False)
+
+
+        score_string += f' set a new high score!'
+
+        if score.song_artist:
+            embed.add_field(name='Artist', value=score.song_artist, inline=False)
+
+        if score.song_mapper:
+            embed.add_field(name='Mapper', value=score.song_mapper, inline=False)
+
+        return (score_string, embed)
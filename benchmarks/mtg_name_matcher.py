@@ -0,0 +1,100 @@
+'''
+Microbenchmark for the offline card name matcher.
+
+Builds a `NameMatcher` over the card names in a card index database (see the mtg `card_index`
+option), or over made-up names if no database is given, then times lookups of misspelled and
+shortened names. Prints the build time, the time per lookup and how often the intended card
+came first, as JSON.
+
+    python3 benchmarks/mtg_name_matcher.py --index cards.db --queries 1000
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from tasks.mtg.name_matcher import NameMatcher
+
+# Rough English letter frequencies, so made-up names share trigrams about as often as real ones
+_LETTERS = 'etaoinshrdlcumwfgypbvkjxqz'
+_WEIGHTS = [12, 9, 8, 8, 7, 7, 6, 6, 6, 4, 4, 3, 3, 2, 2, 2, 2, 2, 2, 1.5, 1, 0.8, 0.2, 0.2, 0.1, 0.1]
+
+
+def made_up_names(count: int, rng: random.Random) -> List[str]:
+    words = [''.join(rng.choices(_LETTERS, _WEIGHTS, k=rng.randint(3, 10))) for _ in range(count // 2)]
+    words += ['of', 'the'] * (count // 100)
+    names = set()
+    while len(names) < count:
+        names.add(' '.join(rng.choice(words) for _ in range(rng.randint(1, 4))).title())
+    return sorted(names)
+
+
+def index_names(path: str) -> List[str]:
+    from tasks.mtg.card_index import CardIndex
+    index = CardIndex(path)
+    names = list(index.build_matcher().names)
+    index.close()
+    return names
+
+
+def misspell(name: str, rng: random.Random) -> str:
+    position = rng.randrange(len(name))
+    return name[:position] + rng.choice('aeiorstn') + name[position + 1:]
+
+
+def percentile(timings: List[float], fraction: float) -> float:
+    return sorted(timings)[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def main(args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    names = index_names(args.index) if args.index else made_up_names(args.names, rng)
+
+    start = time.perf_counter()
+    matcher = NameMatcher(names)
+    build = time.perf_counter() - start
+
+    targets = rng.sample(names, min(args.queries, len(names)))
+    cases = {
+        'misspelled': [(misspell(name, rng), name) for name in targets],
+        'shortened': [(name[:max(3, len(name) - 3)], name) for name in targets],
+    }
+
+    results = {}
+    for (case, queries) in cases.items():
+        timings = []
+        found = 0
+        for (query, name) in queries:
+            start = time.perf_counter()
+            matches = matcher.match(query)
+            timings.append(time.perf_counter() - start)
+            found += bool(matches) and matches[0].name == name
+
+        results[case] = {
+            'ms_mean': round(sum(timings) / len(timings) * 1000, 4),
+            'ms_p99': round(percentile(timings, 0.99) * 1000, 4),
+            'top_match_rate': round(found / len(queries), 3),
+        }
+
+    return {
+        'parameters': vars(args),
+        'names': len(matcher),
+        'build_s': round(build, 3),
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time fuzzy card name lookups')
+    parser.add_argument('--index', help='Card index database to take names from, instead of made-up names')
+    parser.add_argument('--names', type=int, default=30000, help='Number of made-up names')
+    parser.add_argument('--queries', type=int, default=1000, help='Lookups timed for each kind of query')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    print(json.dumps(main(args), indent=2))
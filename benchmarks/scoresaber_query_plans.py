@@ -0,0 +1,118 @@
+'''
+Query plan check for the scoresaber database.
+
+Runs each `Database` query method against a fresh, fully migrated database, captures every SQL
+statement it sends, and checks SQLite's plan for each one. A statement that scans a whole table
+without an index fails the check, unless the method is expected to read everything. Methods
+that return rows in score order must also not need a separate sort.
+
+    python3 benchmarks/scoresaber_query_plans.py
+
+Exits with status 1 if any method fails.
+'''
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from bot_config import ScoresaberConfig
+from tasks.scoresaber.database import Database
+
+# Methods that read every row by design, so a full scan is expected. The backfill table only
+# holds a row per player.
+FULL_SCANS = {'get_players', 'get_high_scores', 'get_player_guilds', 'get_backfill_jobs', 'next_backfill_job'}
+
+# Methods whose results should come straight from an index in order, without a sort
+PRESORTED = {'get_player_scores', 'get_song_scores'}
+
+
+def capture(db: Database, fn: Callable[[], object]) -> List[tuple[str, tuple]]:
+    '''
+    Run a query method, materializing lazy queries, and return the SELECT statements it sent
+    '''
+    statements: List[tuple[str, tuple]] = []
+    execute_sql = db.db.execute_sql
+
+    def recording(sql, params=None, *args, **kwargs):
+        if sql.lstrip().upper().startswith('SELECT'):
+            statements.append((sql, tuple(params or ())))
+        return execute_sql(sql, params, *args, **kwargs)
+
+    db.db.execute_sql = recording
+    try:
+        result = fn()
+        if hasattr(result, '__iter__'):
+            list(result)
+    finally:
+        db.db.execute_sql = execute_sql
+
+    return statements
+
+
+def check(name: str, plan: List[str]) -> List[str]:
+    problems = []
+    # Subqueries SQLite runs on their own; reading back their rows isn't a table scan
+    subqueries = {step.split(' ', 1)[1] for step in plan if step.startswith(('CO-ROUTINE ', 'MATERIALIZE '))}
+    for step in plan:
+        # `SCAN n CONSTANT ROWS` reads the list given to a row value IN, not a table
+        scanned = step.split(' ', 1)[1] if step.startswith('SCAN ') else ''
+        if scanned in subqueries:
+            continue
+        if step.startswith('SCAN') and 'INDEX' not in step and 'CONSTANT ROWS' not in step and name not in FULL_SCANS:
+            problems.append(f'full table scan: {step}')
+        if 'TEMP B-TREE FOR ORDER BY' in step and name in PRESORTED:
+            problems.append(f'sorts results: {step}')
+    return problems
+
+
+def main() -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(ScoresaberConfig(database=os.path.join(directory, 'scores.db')))
+        db.create_player('player', None, '1', 'guild')
+        db.update_scores([{'player': 'player', 'song_hash': 'ABC', 'difficulty': 9, 'score': 1, 'song_name': 'Song',
+                           'image_url': '', 'beatsaver_url': ''}])
+        db.queue_backfill(['player'], time.time())
+
+        methods: Dict[str, Callable[[], object]] = {
+            'get_players': lambda: db.get_players(),
+            'get_players(guild)': lambda: db.get_players('guild'),
+            'get_player_guilds': lambda: db.get_player_guilds(),
+            'get_player_scores': lambda: db.get_player_scores('player', 10),
+            'get_player_scores(guild)': lambda: db.get_player_scores('player', 10, 'guild'),
+            'get_song_scores': lambda: db.get_song_scores('ABC', 9),
+            'get_high_scores': lambda: db.get_high_scores(),
+            'get_song_leaders': lambda: db.get_song_leaders([('ABC', 9), ('DEF', 7)]),
+            'get_top_search': lambda: db.get_top_search('song'),
+            'get_top_search(guild)': lambda: db.get_top_search('song', 'guild'),
+            'get_beatsaver_maps': lambda: db.get_beatsaver_maps(['ABC']),
+            'get_player_progress': lambda: db.get_player_progress('player', time.time() - 86400),
+            'get_most_improved': lambda: db.get_most_improved(time.time() - 86400),
+            'get_most_improved(guild)': lambda: db.get_most_improved(time.time() - 86400, 10, 'guild'),
+            'get_backfill_jobs': lambda: db.get_backfill_jobs(),
+            'get_backfill_job': lambda: db.get_backfill_job('player'),
+            'next_backfill_job': lambda: db.next_backfill_job(),
+        }
+
+        failed = False
+        for (label, fn) in methods.items():
+            name = label.split('(')[0]
+            for (sql, params) in capture(db, fn):
+                plan = [row[-1] for row in db.db.execute_sql(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()]
+                problems = check(name, plan)
+                failed = failed or bool(problems)
+                print(f'{"FAIL" if problems else "ok  "} {label}')
+                for step in plan:
+                    print(f'       {step}')
+                for problem in problems:
+                    print(f'     ! {problem}')
+
+        db.db.close()
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
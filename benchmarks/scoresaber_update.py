@@ -0,0 +1,226 @@
+'''
+Offline benchmark for the scoresaber update pipeline.
+
+Runs a local stand-in for the ScoreSaber and BeatSaver APIs with synthetic players and score
+histories, then drives `ScoreUpdater.update` against a temporary database. Reports wall time,
+HTTP calls, database statements and peak memory for each scenario as JSON.
+
+    python3 benchmarks/scoresaber_update.py --players 50 --scores 500 --output results.json
+'''
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from aiohttp import web
+
+from bot_config import ScoresaberConfig
+from tasks.scoresaber import async_database, beatsaver, client, database, updater
+
+
+class FakeApi:
+    '''
+    Serves synthetic ScoreSaber player scores and BeatSaver map lookups
+    '''
+    def __init__(self, players: int, scores: int, songs: int, latency: float, error_rate: float, seed: int):
+        self.players = players
+        self.scores = {player: scores for player in range(players)}
+        self.songs = songs
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = {'scoresaber': 0, 'beatsaver': 0, 'errors': 0}
+
+
+    def _leaderboard(self, song: int) -> Dict[str, Any]:
+        return {
+            'id': song, 'songHash': f'{song:040X}', 'songName': f'Song {song}', 'songSubName': '',
+            'songAuthorName': f'Artist {song % 50}', 'levelAuthorName': f'Mapper {song % 20}',
+            'difficulty': {'leaderboardId': song, 'difficulty': 9, 'gameMode': 'SoloStandard', 'difficultyRaw': '_ExpertPlus_SoloStandard'},
+            'maxScore': 1000000, 'createdDate': '2020-01-01T00:00:00.000Z', 'rankedDate': None, 'qualifiedDate': None,
+            'lovedDate': None, 'ranked': False, 'qualified': False, 'loved': False, 'maxPP': 0.0, 'stars': 0.0,
+            'plays': 1, 'dailyPlays': 0, 'positiveModifiers': False, 'playerScore': None,
+            'coverImage': f'https://cdn.example/{song}.png',
+            'difficulties': [{'leaderboardId': song * 10 + d, 'difficulty': d, 'gameMode': 'SoloStandard', 'difficultyRaw': f'_{d}_SoloStandard'}
+                             for d in (1, 3, 5, 7, 9)],
+        }
+
+
+    def _score(self, player: int, index: int) -> Dict[str, Any]:
+        return {
+            'id': player * 1_000_000 + index, 'rank': 1, 'baseScore': 500000 + (player * 7919 + index * 104729) % 500000,
+            'modifiedScore': 500000 + (player * 7919 + index * 104729) % 500000, 'pp': 0.0, 'weight': 0.0,
+            'modifiers': '', 'multiplier': 1.0, 'badCuts': 0, 'missedNotes': 0, 'maxCombo': 100, 'fullCombo': False,
+            'hmd': 0, 'timeSet': f'2024-01-01T00:00:00.{index:09d}Z', 'hasReplay': False,
+        }
+
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+    def _fail(self) -> bool:
+        if self.random.random() < self.error_rate:
+            self.calls['errors'] += 1
+            return True
+        return False
+
+
+    async def player_scores(self, request: web.Request) -> web.Response:
+        self.calls['scoresaber'] += 1
+        await self._delay()
+        if self._fail():
+            return web.json_response({}, status=self.random.choice([429, 500, 503]))
+
+        player = int(request.match_info['player'])
+        limit = int(request.query.get('limit', 8))
+        page = int(request.query.get('page', 1))
+        total = self.scores[player]
+
+        # Newest first, like sort=recent
+        indexes = range(total - 1 - (page - 1) * limit, max(-1, total - 1 - page * limit), -1)
+        return web.json_response({
+            'playerScores': [{'score': self._score(player, i), 'leaderboard': self._leaderboard((player + i) % self.songs)} for i in indexes],
+            'metadata': {'total': total, 'page': page, 'itemsPerPage': limit},
+        })
+
+
+    async def maps(self, request: web.Request) -> web.Response:
+        self.calls['beatsaver'] += 1
+        await self._delay()
+        hashes = request.match_info['hashes'].split(',')
+        if len(hashes) == 1:
+            return web.json_response({'id': hashes[0][-5:].lower()})
+        return web.json_response({song_hash: {'id': song_hash[-5:].lower()} for song_hash in hashes})
+
+
+    async def start(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_get('/api/v1/player/{player}/scores', self.player_scores)
+        app.router.add_get('/maps/hash/{hashes}', self.maps)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        return runner
+
+
+class StatementCounter:
+    '''
+    Counts SQL statements run through the peewee database, from any thread
+    '''
+    def __init__(self, db):
+        self.count = itertools.count()
+        self.total = 0
+        execute_sql = db.execute_sql
+
+        def counting(sql, params=None, *args, **kwargs):
+            next(self.count)
+            return execute_sql(sql, params, *args, **kwargs)
+
+        db.execute_sql = counting
+
+
+    def take(self) -> int:
+        # itertools.count is atomic under the GIL; read it by advancing once
+        current = next(self.count)
+        taken = current - self.total
+        self.total = current + 1
+        return taken
+
+
+async def run_scenario(api: FakeApi,
+                       db: async_database.AsyncDatabase,
+                       statements: StatementCounter,
+                       args: argparse.Namespace,
+                       force_all: bool) -> Dict[str, Any]:
+    scoresaber_client = client.ScoresaberClient(args.retries, backoff=0.01, limiter=client.RateLimiter(limit=1_000_000))
+    score_updater = updater.ScoreUpdater(db, args.concurrency, beatsaver.BeatsaverCache(db, batch_size=args.batch_size), scoresaber_client)
+
+    calls_before = dict(api.calls)
+    statements.take()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = await score_updater.update(force_all)
+    wall = time.perf_counter() - start
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    await scoresaber_client.close()
+
+    return {
+        'scenario': 'force_all' if force_all else 'normal',
+        'wall_s': round(wall, 4),
+        'http_calls': {key: api.calls[key] - calls_before[key] for key in api.calls},
+        'db_statements': statements.take(),
+        'peak_memory_mb': round(peak / 1024 / 1024, 2),
+        'new_records': len(records),
+    }
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    api = FakeApi(args.players, args.scores, args.songs, args.latency, args.error_rate, args.seed)
+    runner = await api.start()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    # Point the pipeline at the stand-in instead of the real services
+    updater.scoresaber_url = f'http://127.0.0.1:{port}/api/v1'
+    beatsaver.beatsaver_api_url = f'http://127.0.0.1:{port}'
+
+    results: List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory() as directory:
+        db = async_database.AsyncDatabase(database.Database(ScoresaberConfig(database=os.path.join(directory, 'scores.db'))))
+        statements = StatementCounter(db.database.db)
+
+        for player in range(args.players):
+            db.database.create_player(f'player{player}', None, str(player))
+
+        # Backfill everything, then measure a regular update after each player sets new scores
+        results.append(await run_scenario(api, db, statements, args, force_all=True))
+        for player in api.scores:
+            api.scores[player] += args.new_scores
+        results.append(await run_scenario(api, db, statements, args, force_all=False))
+
+        db.close()
+
+    await runner.cleanup()
+
+    return {
+        'parameters': {key: value for (key, value) in vars(args).items() if key != 'output'},
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the scoresaber update pipeline against a local API stand-in')
+    parser.add_argument('--players', type=int, default=20, help='Number of registered players')
+    parser.add_argument('--scores', type=int, default=200, help='Scores in each player\'s history')
+    parser.add_argument('--songs', type=int, default=500, help='Number of distinct songs the scores are spread over')
+    parser.add_argument('--new-scores', type=int, default=5, help='New scores per player before the normal update')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every API response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of ScoreSaber requests answered with 429/5xx')
+    parser.add_argument('--concurrency', type=int, default=4, help='Players fetched at once')
+    parser.add_argument('--batch-size', type=int, default=50, help='Hashes per BeatSaver request')
+    parser.add_argument('--retries', type=int, default=3, help='Retries for failed ScoreSaber requests')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for injected errors')
+    parser.add_argument('--port', type=int, default=0, help='Port for the API stand-in (0 picks a free one)')
+    parser.add_argument('--output', help='Write results to this file instead of stdout')
+    args = parser.parse_args()
+
+    report = json.dumps(asyncio.run(main(args)), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
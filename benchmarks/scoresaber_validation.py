@@ -0,0 +1,77 @@
+'''
+Microbenchmark for decoding and validating a page of ScoreSaber player scores.
+
+Compares the full `ScoresaberLeaderboard`/`ScoresaberScore` models validated one wrapper at a
+time against the slim projection models validated a page at a time, with each available JSON
+decoder. Prints the time per page for each as JSON.
+
+    python3 benchmarks/scoresaber_validation.py --page-size 100 --pages 200
+'''
+import argparse
+import json
+import os
+import sys
+import timeit
+from typing import Any, Callable, Dict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from tasks.scoresaber import ScoresaberLeaderboard, ScoresaberScore, player_scores_adapter
+from tasks.scoresaber.client import json_loads
+
+from scoresaber_update import FakeApi
+
+
+def full_models(body: bytes) -> list:
+    return [(ScoresaberLeaderboard.model_validate(wrapper['leaderboard']), ScoresaberScore.model_validate(wrapper['score']))
+            for wrapper in json.loads(body)['playerScores']]
+
+
+def slim_stdlib(body: bytes) -> list:
+    return player_scores_adapter.validate_python(json.loads(body)['playerScores'])
+
+
+def slim_fast_loads(body: bytes) -> list:
+    return player_scores_adapter.validate_python(json_loads(body)['playerScores'])
+
+
+def main(args: argparse.Namespace) -> Dict[str, Any]:
+    api = FakeApi(1, args.page_size, args.songs, 0.0, 0.0, 0)
+    body = json.dumps({
+        'playerScores': [{'score': api._score(0, i), 'leaderboard': api._leaderboard(i % args.songs)} for i in range(args.page_size)],
+        'metadata': {'total': args.page_size, 'page': 1, 'itemsPerPage': args.page_size},
+    }).encode()
+
+    cases: Dict[str, Callable[[bytes], list]] = {
+        'full_models_json': full_models,
+        'slim_adapter_json': slim_stdlib,
+    }
+    if json_loads is not json.loads:
+        cases[f'slim_adapter_{json_loads.__module__}'] = slim_fast_loads
+
+    results = {}
+    for (name, case) in cases.items():
+        case(body)
+        best = min(timeit.repeat(lambda: case(body), number=args.pages, repeat=args.repeat))
+        results[name] = {'ms_per_page': round(best / args.pages * 1000, 4)}
+
+    baseline = results['full_models_json']['ms_per_page']
+    for result in results.values():
+        result['speedup'] = round(baseline / result['ms_per_page'], 2)
+
+    return {
+        'parameters': vars(args),
+        'page_bytes': len(body),
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the full and slim ScoreSaber validation paths')
+    parser.add_argument('--page-size', type=int, default=100, help='Scores per page')
+    parser.add_argument('--pages', type=int, default=200, help='Pages decoded per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing runs; the fastest is reported')
+    parser.add_argument('--songs', type=int, default=500, help='Number of distinct songs the scores are spread over')
+    args = parser.parse_args()
+
+    print(json.dumps(main(args), indent=2))